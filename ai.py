@@ -1,6 +1,9 @@
 import onitama as oni
 from collections import namedtuple
+import math
+import time
 from evaluators import Evaluator
+from transposition import *
 from constants import *
 
 '''
@@ -15,13 +18,42 @@ the player performing the move identified by RED = 0, BLUE = 1
 
 Card.moves is an array of arrays where obj.moves[i] contains all legal destination
 squares for a move starting on square i
+
+Card.masks holds the same data as 25-bit ints (bit j set if square j is a destination),
+and the AIs keep each side's pieces as a 25-bit int too (bit i set if square i is occupied).
+The legal destinations for a piece on square i are then card.masks[player][i] & ~own
+Together with the board and the kings' squares, these are all the AIs know of the pieces
 '''
 
+# Used by find_move when only a time limit is given
+DEFAULT_MAX_DEPTH = 64
+
+# Forward pruning parameters, see MoveUnmoveAI.search
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+LMR_MIN_DEPTH = 3
+LMR_MOVES = 3
+
+# Search algorithms for MoveUnmoveAI.search
+ALGORITHMS = ['alphabeta', 'pvs']
+
+# Move ordering priorities, see MoveUnmoveAI.move_selector
+# History scores stay below KILLER_PRIORITY in any realistic search
+HASH_MOVE_PRIORITY = 1 << 62
+CAPTURE_PRIORITY = 1 << 61
+KILLER_PRIORITY = 1 << 60
+
+# History scores are indexed by (piece, start, end, card), see history_index
+HISTORY_SIZE = 5*25*25*5
+
 def create_ai(version='unmove', game=None):
     if version == 'unmove':
         return MoveUnmoveAI(game)
     elif version == 'copy':
         return CopyMoveAI(game)
+    elif version == 'parallel':
+        from parallel import ParallelAI
+        return ParallelAI(game)
 
 '''
 For now, two versions of the AI
@@ -38,10 +70,11 @@ I'll keep them both for testing, but eventually the worse one will just be remov
 
 class CopyMoveAI:
     class Node:
-        __slots__ = ['board', 'prev_move', 'cards', 'children', 'parent', 'end', 'eval']
+        __slots__ = ['board', 'bitboards', 'prev_move', 'cards', 'children', 'parent', 'end', 'eval']
 
-        def __init__(self, board, prev_move, cards, children, parent, end):
+        def __init__(self, board, bitboards, prev_move, cards, children, parent, end):
             self.board = board
+            self.bitboards = bitboards
             self.prev_move = prev_move
             self.cards = cards
             self.children = children
@@ -68,8 +101,10 @@ class CopyMoveAI:
             game.start_cards.index(card)
             for card in game.cards[oni.Player.RED]+game.cards[oni.Player.BLUE]+[game.neutral_card]
         ]
+        board = convert_board(self.game.board.array)
         self.root = self.Node(
-            board=convert_board(self.game.board.array),
+            board=board,
+            bitboards=create_bitboards(board),
             prev_move=None,
             cards=cards,
             children=[],
@@ -93,12 +128,16 @@ class CopyMoveAI:
                 gameover = False
         new_board[move.end] = new_board[move.start]
         new_board[move.start] = EMPTY
+        new_bitboards = node.bitboards[:]
+        new_bitboards[move.player] ^= 1 << move.start | 1 << move.end
+        new_bitboards[1-move.player] &= ~(1 << move.end)
         new_cards = node.cards[:]
         # Swap index(move.card) with index 4
         new_cards[new_cards.index(move.card)] = new_cards[4]
         new_cards[4] = move.card
         return self.Node(
             board=new_board,
+            bitboards=new_bitboards,
             prev_move=move,
             cards=new_cards,
             children=[],
@@ -142,15 +181,14 @@ class CopyMoveAI:
             player = self.card_data[4].start_player
         else:
             player = (node.prev_move.player+1) % 2
-        pieces = [REDPAWN, REDKING] if player == RED else [BLUEPAWN, BLUEKING]
-        start_squares = [i for i in range(25) if node.board[i] in pieces]
-        player_cards = node.cards[player*2:player*2+2]
+        own = node.bitboards[player]
+        Move = self.Move
         return [
-            self.Move(start=start, end=end, player=player, card=card)
-            for start in start_squares
-            for card in player_cards
-            for end in self.card_data[card].moves[player][start]
-            if end not in start_squares
+            Move(start, end, player, card)
+            for card in node.cards[player*2:player*2+2]
+            for masks in (self.card_data[card].masks[player],)
+            for start in SQUARES[own]
+            for end in SQUARES[masks[start] & ~own]
         ]
 
     def get_nodes(self, depth):
@@ -183,10 +221,62 @@ class MoveUnmoveAI:
             self.card = card
             self.neutral_card = neutral_card
 
-    def __init__(self, game=None):
+        # Compact integer form of the move, as stored in the transposition table
+        def code(self):
+            return self.start | self.end << 5 | self.card << 10
+
+    def __init__(self, game=None, tt_bits=18, incremental_eval=True, tablebase=None, book=None,
+                 killer_moves=True, history_heuristic=True, algorithm='alphabeta', aspiration=0.25,
+                 null_move=False, late_move_reductions=False, futility=False, evaluator_options=None,
+                 tt=None, cache=None):
+        # tt: a table to search with instead of a new one with 2**tt_bits slots,
+        # e.g. a SharedTranspositionTable used by other processes too
+        if tt is None and tt_bits:
+            tt = TranspositionTable(tt_bits)
+        self.tt = tt
+        self.incremental_eval = incremental_eval
+        # Keyword arguments for Evaluator, e.g. to change its weights
+        self.evaluator_options = evaluator_options or dict()
+        # A tablebase.TableBase, probed only when it covers the game's cards
+        self.tablebase = tablebase
+        self.use_tablebase = False
+        # A book.Book, consulted by find_move before searching
+        self.book = book
+        # A cache.AnalysisCache, consulted by find_move before searching and
+        # given its result afterwards
+        self.cache = cache
+        self.best_move = None
+        self.deadline = None
+        # Set by find_move, see out_of_time
+        self.stop_event = None
+        self.pv = [[]]
+        self.root_scores = dict()
+        # Move ordering heuristics for search, see move_selector
+        self.use_killers = killer_moves
+        self.use_history = history_heuristic
+        self.killers = []
+        self.history = [0] * HISTORY_SIZE
+        self.reset_counters()
+        self.stats = SearchStats()
+        # Forward pruning in search, each off by default, see search
+        self.null_move = null_move
+        self.late_move_reductions = late_move_reductions
+        self.futility = futility
+        # Search algorithm for find_move, 'alphabeta' or 'pvs', see search
+        if algorithm not in ALGORITHMS:
+            raise ValueError('unknown search algorithm: {}'.format(algorithm))
+        self.pvs = algorithm == 'pvs'
+        # Half-width of the aspiration window, or None for full windows
+        self.aspiration = aspiration
         if game != None:
             self.set_game_as_root(game)
 
+    # The counters are plain attributes, to keep the search fast.
+    # find_move copies them into self.stats, see SearchStats
+    def reset_counters(self):
+        for name in SearchStats.COUNTERS:
+            setattr(self, name, 0)
+
     def set_game_as_root(self, game):
         self.game = game
         self.card_data = tuple(create_card(oni.CARD_TO_NAME[card]) for card in game.start_cards)
@@ -203,103 +293,228 @@ class MoveUnmoveAI:
             end=True if game.check_victory() is not None else False,
             eval=0,
         )
-        # Map each piece to a set containing the
-        # squares that are occupied by the pieces of that type
-        self.pieces = {
-            REDPAWN: set(),
-            BLUEPAWN: set(),
-            REDKING: set(),
-            BLUEKING: set(),
-        }
-        for i, piece in enumerate(self.board):
-            if piece != EMPTY:
-                self.pieces[piece].add(i)
+        self.bitboards = create_bitboards(self.board)
+        # self.kings[player] is the square of player's king, None once captured
+        self.kings = find_kings(self.board)
+        self.card_keys = [CARD_KEYS[card.name] for card in self.card_data]
+        self.hash = zobrist_hash(self.board, self.cards, self.card_data, self.active_player)
+        # For the incremental evaluator: self.mobility[player][card] counts the moves
+        # card (an index into card_data) would give player in the current position
+        self.mobility_masks = [
+            [(card.masks[player], card.masks[1-player]) for card in self.card_data]
+            for player in [RED, BLUE]
+        ]
+        self.mobility = [
+            [
+                sum((card.masks[player][sq] & ~self.bitboards[player]).bit_count()
+                    for sq in SQUARES[self.bitboards[player]])
+                for card in self.card_data
+            ]
+            for player in [RED, BLUE]
+        ]
         self.evaluator = Evaluator(
             board=self.board,
-            pieces=self.pieces,
+            bitboards=self.bitboards,
+            kings=self.kings,
             cards=self.cards,
             card_data=self.card_data,
+            mobility_counts=self.mobility if self.incremental_eval else None,
+            **self.evaluator_options
         )
+        self.use_tablebase = self.tablebase is not None and self.tablebase.covers(self.card_data)
+        self.futility_margin = self.evaluator.futility_margin()
 
     def next_moves(self):
-        pieces = [REDPAWN, REDKING] if self.active_player == RED else [BLUEPAWN, BLUEKING]
-        start_squares = [i for i in range(25) if self.board[i] in pieces]
-        player_cards = self.cards[self.active_player*2:self.active_player*2+2]
-        return set(
-            self.Move(start=start, end=end, source=self.board[start], target=self.board[end], player=self.active_player, card=card, neutral_card=self.cards[4])
-            for start in start_squares
-            for card in player_cards
-            for end in self.card_data[card].moves[self.active_player][start]
-            if end not in start_squares
-        )
+        player = self.active_player
+        own = self.bitboards[player]
+        board = self.board
+        neutral_card = self.cards[4]
+        Move = self.Move
+        return [
+            Move(start, board[start], end, board[end], player, card, neutral_card)
+            for card in self.cards[player*2:player*2+2]
+            for masks in (self.card_data[card].masks[player],)
+            for start in SQUARES[own]
+            for end in SQUARES[masks[start] & ~own]
+        ]
 
     # For best alpha-beta pruning performance need to select moves
     # in a good order, where potentially best moves are checked first
-    # Return all captures (and immediate wins) on the first iteration
-    def move_selector(self, move_set, player):
+    # Order: the hash move (a move code from the transposition table), then
+    # captures and immediate wins, then (given the ply, in search) the killer
+    # moves for that ply and the rest by their history score.
+    # Moves that tie keep the order next_moves generated them in
+    def move_selector(self, move_set, player, hash_move=None, ply=None):
         if player == RED:
-            targets = [BLUEPAWN, BLUEKING]
+            targets = (BLUEPAWN, BLUEKING)
             king = REDKING
             goal = REDGOAL
         else:
-            targets = [REDPAWN, REDKING]
+            targets = (REDPAWN, REDKING)
             king = BLUEKING
             goal = BLUEGOAL
-        def winner(move):
-            return move.source == king and move.end == goal
-        def capture(move):
-            return move.target in targets
-        selected = set()
-        for move in move_set:
-            if capture(move) or winner(move):
-                yield move
-                selected.add(move)
-        for move in move_set:
-            if move not in selected:
-                yield move
+        killers = self.killers[ply] if ply is not None and self.use_killers else ()
+        history = self.history if ply is not None and self.use_history else None
+        def priority(move):
+            code = move.code()
+            if code == hash_move:
+                return HASH_MOVE_PRIORITY
+            if move.target in targets or (move.source == king and move.end == goal):
+                return CAPTURE_PRIORITY
+            if code in killers:
+                return KILLER_PRIORITY - killers.index(code)
+            if history is not None:
+                return history[history_index(move)]
+            return 0
+        return iter(sorted(move_set, key=priority, reverse=True))
+
+    # A beta cutoff by a quiet move (no capture, no win) at ply: make it the
+    # first killer move for the ply, and credit its history score
+    def record_cutoff(self, move, depth, ply):
+        if move.target != EMPTY:
+            return
+        if move.end == (REDGOAL if move.player == RED else BLUEGOAL) and move.source in (REDKING, BLUEKING):
+            return
+        if self.use_killers:
+            code = move.code()
+            killers = self.killers[ply]
+            if killers[0] != code:
+                killers[1] = killers[0]
+                killers[0] = code
+        if self.use_history:
+            self.history[history_index(move)] += depth*depth
 
     def evaluate_current(self):
+        self.evaluations += 1
         return self.evaluator.evaluate(self.active_player)
 
     def do_move(self, move, node):
-        source = self.board[move.start]
-        if source == REDKING and move.end == REDGOAL:
-            gameover = True
-        elif source == BLUEKING and move.end == BLUEGOAL:
-            gameover = True
-        elif move.target == REDKING or move.target == BLUEKING:
-            gameover = True
-        else:
-            gameover = False
-        self.board[move.end] = self.board[move.start]
-        self.board[move.start] = EMPTY
-        self.cards[self.cards.index(move.card)] = self.cards[4]
-        self.cards[4] = move.card
-        self.active_player = (self.active_player+1)%2
-        self.pieces[source].remove(move.start)
-        self.pieces[source].add(move.end)
-        if move.target != EMPTY:
-            self.pieces[move.target].remove(move.end)
         return self.Node(
             prev_move = move,
             children=[],
             parent=node,
-            end=gameover,
+            end=self.make_move(move),
             eval=None,
         )
 
+    # do_move without building a Node, for the tree-free search
+    # Returns True if the move ends the game
+    def make_move(self, move):
+        self.update_hash(move)
+        if self.incremental_eval:
+            player = move.player
+            own = self.bitboards[player] ^ 1 << move.start
+            self.update_mobility(player, own, move.start, -1)
+            self.update_mobility(player, own, move.end, 1)
+            if move.target != EMPTY:
+                self.update_mobility(1-player, self.bitboards[1-player] ^ 1 << move.end, move.end, -1)
+        return self.move_pieces(move)
+
     def undo_move(self, move):
-        source = self.board[move.end]
-        self.pieces[source].remove(move.end)
-        self.pieces[source].add(move.start)
+        if self.incremental_eval:
+            player = move.player
+            own = self.bitboards[player] ^ 1 << move.end
+            self.update_mobility(player, own, move.end, -1)
+            self.update_mobility(player, own, move.start, 1)
+            if move.target != EMPTY:
+                self.update_mobility(1-player, self.bitboards[1-player], move.end, 1)
+        self.unmove_pieces(move)
+        self.update_hash(move)
+
+    # make_move without the hash and mobility updates: only the board, bitboards,
+    # kings, cards and player to move, which is all next_moves needs
+    # Returns True if the move ends the game
+    def move_pieces(self, move):
+        source = move.source
+        if source == REDKING:
+            self.kings[RED] = move.end
+            gameover = move.end == REDGOAL
+        elif source == BLUEKING:
+            self.kings[BLUE] = move.end
+            gameover = move.end == BLUEGOAL
+        else:
+            gameover = False
+        if move.target == REDKING or move.target == BLUEKING:
+            self.kings[1-move.player] = None
+            gameover = True
+        self.board[move.end] = source
+        self.board[move.start] = EMPTY
+        self.cards[self.cards.index(move.card)] = self.cards[4]
+        self.cards[4] = move.card
+        self.active_player = 1 - move.player
+        self.bitboards[move.player] ^= 1 << move.start | 1 << move.end
         if move.target != EMPTY:
-            self.pieces[move.target].add(move.end)
+            self.bitboards[1-move.player] ^= 1 << move.end
+        return gameover
+
+    def unmove_pieces(self, move):
+        source = move.source
+        if source == REDKING or source == BLUEKING:
+            self.kings[move.player] = move.start
+        if move.target == REDKING or move.target == BLUEKING:
+            self.kings[1-move.player] = move.end
+        self.bitboards[move.player] ^= 1 << move.start | 1 << move.end
+        if move.target != EMPTY:
+            self.bitboards[1-move.player] ^= 1 << move.end
         self.board[move.start] = source
         self.board[move.end] = move.target
         self.cards[self.cards.index(move.neutral_card)] = move.card
         self.cards[4] = move.neutral_card
-        self.active_player = (self.active_player+1)%2
+        self.active_player = move.player
+
+    # Checked every 1024 nodes: the search is abandoned once the deadline
+    # has passed or the stop event (e.g. a threading.Event) is set
+    def out_of_time(self):
+        return ((self.deadline is not None and time.monotonic() > self.deadline)
+                or (self.stop_event is not None and self.stop_event.is_set()))
+
+    # Passing, for null-move pruning: the other player moves next, nothing else changes
+    # Its own inverse
+    def make_null_move(self):
+        self.active_player = 1 - self.active_player
+        self.hash ^= SIDE_KEY
+
+    # True if player could end the game with its next move, by capturing
+    # the other king or by moving its own king to its goal square
+    def can_win_now(self, player):
+        own = self.bitboards[player]
+        king, enemy_king = self.kings[player], self.kings[1-player]
+        goal = REDGOAL if player == RED else BLUEGOAL
+        for card in self.cards[player*2:player*2+2]:
+            masks = self.card_data[card].masks
+            # Pieces that reach a square are those the other player's masks reach from it
+            if enemy_king is not None and masks[1-player][enemy_king] & own:
+                return True
+            if king is not None and masks[player][king] >> goal & 1:
+                return True
+        return False
+
+    # Adjust self.mobility for a piece of player's being added to (sign = 1)
+    # or removed from (sign = -1) square, where own is the player's bitboard
+    # without that piece. The piece gains or loses its own moves, and other pieces
+    # that could reach square lose or gain one. Pieces that reach square with
+    # a card are exactly those that the opposite player's masks reach from square
+    def update_mobility(self, player, own, square, sign):
+        counts = self.mobility[player]
+        free = ~own
+        for i, (masks, reverse) in enumerate(self.mobility_masks[player]):
+            counts[i] += sign*((masks[square] & free).bit_count()
+                               - (reverse[square] & own).bit_count())
+
+    # XOR keys are their own inverse, so the same update serves do_move and undo_move
+    def update_hash(self, move):
+        piece_keys = PIECE_KEYS[move.source]
+        card_keys = self.card_keys[move.card]
+        neutral_keys = self.card_keys[move.neutral_card]
+        key = (self.hash ^ SIDE_KEY ^ piece_keys[move.start] ^ piece_keys[move.end]
+               ^ card_keys[move.player] ^ card_keys[NEUTRAL]
+               ^ neutral_keys[NEUTRAL] ^ neutral_keys[move.player])
+        if move.target != EMPTY:
+            key ^= PIECE_KEYS[move.target][move.end]
+        self.hash = key
 
+    # Expands the whole tree. Nothing is evaluated or looked up, so the moves
+    # skip the hash and mobility updates
     def mock_search(self, depth):
         def search_children(start_node, depth):
             if depth <= 0 or start_node.end:
@@ -307,9 +522,15 @@ class MoveUnmoveAI:
             moves = self.next_moves()
             start_node.children = [0 for _ in range(len(moves))]
             for i, move in enumerate(moves):
-                start_node.children[i] = self.do_move(move, start_node)
+                start_node.children[i] = self.Node(
+                    prev_move=move,
+                    children=[],
+                    parent=start_node,
+                    end=self.move_pieces(move),
+                    eval=None,
+                )
                 search_children(start_node.children[i], depth-1)
-                self.undo_move(move)
+                self.unmove_pieces(move)
         search_children(self.root, depth)
 
     def get_nodes(self, depth):
@@ -320,42 +541,315 @@ class MoveUnmoveAI:
 
     # Standard implementation of alpha-beta pruning (using the negamax perspective)
     # Missing the VERY import queiscence search once depth is reached!
+    # Positions already searched at least as deep are answered from the
+    # transposition table, and the stored best move is tried first otherwise
+    # At the root, the best move of the previous iteration (if any) goes first
+    # Below the root, positions found in the tablebase are not searched at all
     def alphabeta(self, alpha, beta, node, depth):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and self.out_of_time():
+            raise SearchTimeout
+        if self.use_tablebase and not node.end and node is not self.root:
+            score = self.tablebase.probe(self)
+            if score is not None:
+                node.eval = score
+                return score
         if depth == 0 or node.end:
             node.eval = self.evaluate_current()
             return node.eval
+        hash_move = None
+        if self.tt is not None:
+            entry = self.tt.probe(self.hash)
+            if entry is not None:
+                hash_move = entry.move
+                if entry.depth >= depth and node is not self.root:
+                    if entry.flag == EXACT:
+                        node.eval = entry.score
+                        return entry.score
+                    if entry.flag == LOWER and entry.score >= beta:
+                        return beta
+                    if entry.flag == UPPER and entry.score <= alpha:
+                        return alpha
+        if node is self.root and self.best_move is not None:
+            hash_move = self.best_move.code()
+        alpha_orig = alpha
+        best_move = None
         moves = self.next_moves()
         node.children = [None for _ in range(len(moves))]
-        move_gen = self.move_selector(moves, self.active_player)
+        move_gen = self.move_selector(moves, self.active_player, hash_move)
         for i, move in enumerate(move_gen):
             node.children[i] = self.do_move(move, node)
-            score = -self.alphabeta(-beta, -alpha, node.children[i], depth-1)
-            if score >= beta:
+            try:
+                score = -self.alphabeta(-beta, -alpha, node.children[i], depth-1)
+            finally:
                 self.undo_move(move)
+            if score >= beta:
+                if self.tt is not None:
+                    self.tt.store(self.hash, depth, LOWER, beta, move.code())
+                if node is self.root:
+                    self.best_move = move
                 return beta
+            if score > alpha or best_move is None:
+                best_move = move
             if score > alpha:
                 alpha = score
-            self.undo_move(move)
+        if self.tt is not None and best_move is not None:
+            flag = EXACT if alpha > alpha_orig else UPPER
+            self.tt.store(self.hash, depth, flag, alpha, best_move.code())
+        if node is self.root:
+            self.best_move = best_move
         node.eval = alpha
         return alpha
 
-    def find_move(self, depth):
-        score = self.alphabeta(
-            alpha=-float('inf'),
-            beta=float('inf'),
-            depth=depth,
-            node=self.root,
-        )
-        # path = [self.root]
-        # curr = self.root
-        # for _ in range(depth):
-        #     children = [node for node in curr.children if node.eval != None]
-        #     curr = max(children, key=lambda x: -x.eval)
-        #     path.append(curr)
-        for node in self.root.children:
-            if node.eval == -score:
-                return node.prev_move
+    # The same search as alphabeta, without a tree: no Node objects are created
+    # and only the principal variation and root move scores are kept.
+    # self.pv[ply] is the best line found from ply onwards, so self.pv[0] is
+    # the principal variation after a search. self.root_scores maps the code of
+    # each root move searched to its score, exact for the best move and an upper
+    # bound for the others.
+    # Leaves after a move that ends the game are evaluated without a call
+    # With the 'pvs' algorithm (principal variation search), only the first move
+    # gets the full window. The others are searched with a null window around
+    # alpha and searched again with the full window if they turn out better
+    #
+    # Forward pruning, each switched on separately:
+    # null_move: below the root, if the side to move is already doing well enough
+    #   to fail high, let it pass and search the opponent's reply NULL_MOVE_REDUCTION
+    #   plies shallower; if even that fails high, give up on the node. Passing is
+    #   not legal, and in Onitama a move can hurt just by giving away a card, so this
+    #   is skipped when the side to move has only its king, or when the
+    #   opponent threatens to win on the spot, and never done twice in a row
+    # late_move_reductions: quiet moves after the first LMR_MOVES are searched a ply
+    #   shallower with a null window, and again at full depth if they beat alpha
+    # futility: one ply from the leaves, quiet moves are skipped when the static
+    #   evaluation plus the evaluator's futility margin cannot reach alpha
+    def search(self, alpha, beta, depth, ply=0, allow_null=True):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and self.out_of_time():
+            raise SearchTimeout
+        pv = self.pv
+        while len(pv) <= ply + 1:
+            pv.append([])
+        pv[ply] = []
+        if ply and self.use_tablebase:
+            score = self.tablebase.probe(self)
+            if score is not None:
+                return score
+        if depth == 0:
+            return self.evaluate_current()
+        hash_move = None
+        if self.tt is not None:
+            entry = self.tt.probe(self.hash)
+            if entry is not None:
+                hash_move = entry.move
+                if entry.depth >= depth and ply:
+                    if entry.flag == EXACT:
+                        return entry.score
+                    if entry.flag == LOWER and entry.score >= beta:
+                        return beta
+                    if entry.flag == UPPER and entry.score <= alpha:
+                        return alpha
+        if ply == 0 and self.best_move is not None:
+            hash_move = self.best_move.code()
+        player = self.active_player
+        if (self.null_move and allow_null and ply and depth >= NULL_MOVE_MIN_DEPTH
+                and beta != math.inf and self.bitboards[player].bit_count() > 1
+                and not self.can_win_now(1-player) and self.evaluate_current() >= beta):
+            self.null_move_tries += 1
+            self.make_null_move()
+            try:
+                score = -self.search(-beta, -math.nextafter(beta, -math.inf),
+                                     depth-1-NULL_MOVE_REDUCTION, ply+1, allow_null=False)
+            finally:
+                self.make_null_move()
+            if score >= beta:
+                self.null_move_cutoffs += 1
+                return beta
+        futile = False
+        if self.futility and depth == 1 and ply:
+            static = self.evaluate_current()
+            futile = abs(static) != math.inf and static + self.futility_margin <= alpha
+        reduce = self.late_move_reductions and ply and depth >= LMR_MIN_DEPTH
+        if player == RED:
+            king, goal = REDKING, REDGOAL
+        else:
+            king, goal = BLUEKING, BLUEGOAL
+        while len(self.killers) <= ply:
+            self.killers.append([None, None])
+        alpha_orig = alpha
+        best_move = None
+        moves = self.move_selector(self.next_moves(), player, hash_move, ply)
+        for i, move in enumerate(moves):
+            quiet = move.target == EMPTY and not (move.source == king and move.end == goal)
+            if futile and quiet:
+                self.futility_prunes += 1
+                continue
+            try:
+                if self.make_move(move):
+                    self.nodes += 1
+                    score = -self.evaluate_current()
+                    pv[ply+1] = []
+                else:
+                    score = None
+                    if reduce and quiet and i >= LMR_MOVES:
+                        self.lmr_reductions += 1
+                        score = -self.search(-math.nextafter(alpha, math.inf), -alpha, depth-2, ply+1)
+                        if score > alpha:
+                            self.lmr_researches += 1
+                            score = None
+                    if score is None and (i == 0 or not self.pvs):
+                        score = -self.search(-beta, -alpha, depth-1, ply+1)
+                    elif score is None:
+                        # Null window: only find out whether the move beats alpha
+                        score = -self.search(-math.nextafter(alpha, math.inf), -alpha, depth-1, ply+1)
+                        if alpha < score < beta:
+                            self.pvs_researches += 1
+                            score = -self.search(-beta, -alpha, depth-1, ply+1)
+            finally:
+                self.undo_move(move)
+            if ply == 0:
+                self.root_scores[move.code()] = score
+            if score >= beta:
+                self.cutoffs += 1
+                if i == 0:
+                    self.first_move_cutoffs += 1
+                self.record_cutoff(move, depth, ply)
+                if self.tt is not None:
+                    self.tt.store(self.hash, depth, LOWER, beta, move.code())
+                if ply == 0:
+                    self.best_move = move
+                pv[ply] = [move] + pv[ply+1]
+                return beta
+            if score > alpha or best_move is None:
+                best_move = move
+                pv[ply] = [move] + pv[ply+1]
+            if score > alpha:
+                alpha = score
+        if self.tt is not None and best_move is not None:
+            flag = EXACT if alpha > alpha_orig else UPPER
+            self.tt.store(self.hash, depth, flag, alpha, best_move.code())
+        if ply == 0:
+            self.best_move = best_move
+        return alpha
+
+    # Iterative deepening: search to depth 1, 2, ... up to max_depth, each
+    # iteration starting from the best move of the one before.
+    # Uses the tree-free search, self.principal_variation holds the best line.
+    # With a time_limit (in seconds), the iteration running at the deadline is
+    # abandoned and the best move of the last completed depth is returned.
+    # The first iteration always completes, so a move is always found.
+    # find_move(depth) searches to exactly that depth, as before.
+    # Positions in the opening book are answered without searching, and so
+    # are positions in the analysis cache searched at least max_depth deep.
+    # Setting stop (anything with an is_set method, e.g. a threading.Event)
+    # from another thread ends the search like the deadline does, but the
+    # first iteration too, so None is returned if it is set early enough.
+    # progress, if given, is called with the AI after each completed depth.
+    # self.stats holds the search statistics afterwards (and in progress).
+    def find_move(self, depth=None, time_limit=None, max_depth=None, stop=None, progress=None):
+        self.stats = SearchStats()
+        if self.book is not None:
+            move, entry = self.book.lookup(self)
+            if move is not None:
+                self.best_move = move
+                self.completed_depth, self.score = entry[1], entry[2]
+                self.stats.book_move = True
+                self.principal_variation = [move]
+                self.reset_counters()
+                return move
+        if max_depth is None:
+            max_depth = depth if depth is not None else DEFAULT_MAX_DEPTH
+        self.new_search()
+        start = time.monotonic()
+        self.best_move = None
+        self.score = None
+        self.completed_depth = 0
+        self.reset_counters()
+        self.principal_variation = []
+        best_move = None
+        if self.root.end:
+            return None
+        if self.cache is not None:
+            move = self.start_from_cache(max_depth)
+            if move is not None:
+                return move
+        self.stop_event = stop
+        try:
+            for d in range(1, max_depth+1):
+                if d > 1 and time_limit is not None:
+                    self.deadline = start + time_limit
+                    if time.monotonic() > self.deadline:
+                        break
+                if stop is not None and stop.is_set():
+                    break
+                self.pv = [[]]
+                self.root_scores = dict()
+                self.score = self.search_root(d)
+                best_move = self.best_move
+                self.principal_variation = self.pv[0]
+                self.completed_depth = d
+                self.stats.record_depth(self, time.monotonic() - start)
+                if progress is not None:
+                    progress(self)
+                if abs(self.score) == float('inf'):
+                    # Forced result, deeper searches cannot change it
+                    break
+        except SearchTimeout:
+            self.best_move = best_move
+        finally:
+            self.deadline = None
+            self.stop_event = None
+            self.stats.update(self, time.monotonic() - start)
+        if self.cache is not None and best_move is not None:
+            self.cache.store(self, best_move, self.completed_depth, self.score)
+        return best_move
+
+    # Start a new search: entries of the transposition table from earlier
+    # searches may now be replaced (unless age_table is False, for a table
+    # aged by someone else), killer moves are forgotten and history scores halved
+    def new_search(self, age_table=True):
+        if self.tt is not None and age_table:
+            self.tt.new_search()
+        self.killers = []
+        # Age the history scores, so older searches count for less
+        self.history = [score // 2 for score in self.history]
 
+    # Look the root up in the analysis cache. A result at least max_depth deep,
+    # or a forced one, is returned as the move to play. Anything shallower is
+    # put in the transposition table, to be searched first
+    def start_from_cache(self, max_depth):
+        move, entry = self.cache.lookup(self)
+        if move is None:
+            return None
+        depth, score = entry[1], entry[2]
+        if depth >= max_depth or abs(score) == float('inf'):
+            self.best_move = move
+            self.completed_depth, self.score = depth, score
+            self.principal_variation = [move]
+            self.stats.cached_move = True
+            return move
+        if self.tt is not None:
+            self.tt.store(self.hash, depth, EXACT, score, move.code())
+        return None
+
+    # Search the root to depth. With aspiration windows, the window is first
+    # set to the previous iteration's score +- self.aspiration, and opened up
+    # on the failing side if the true score turns out to lie outside it
+    def search_root(self, depth):
+        inf = float('inf')
+        if self.aspiration is None or self.score is None or abs(self.score) == inf:
+            return self.search(-inf, inf, depth)
+        low, high = self.score - self.aspiration, self.score + self.aspiration
+        while True:
+            score = self.search(low, high, depth)
+            if score <= low and low != -inf:
+                low = -inf
+            elif score >= high and high != inf:
+                high = inf
+            else:
+                return score
+            self.aspiration_researches += 1
+            self.root_scores = dict()
 
     # Bad search strategy!
     # Just for testing
@@ -383,18 +877,107 @@ class MoveUnmoveAI:
         card = oni.NAME_TO_CARD[card_name]
         return oni.Move(player, start, end, card)
 
+# Statistics for one find_move call, in MoveUnmoveAI.stats
+# The counters are totals over the whole search. depths holds one
+# DepthStats per completed iteration, with that iteration's own node count
+# and the time since the search started
+DepthStats = namedtuple('DepthStats', 'depth score nodes seconds')
+
+class SearchStats:
+    COUNTERS = (
+        'nodes', 'evaluations', 'cutoffs', 'first_move_cutoffs',
+        'pvs_researches', 'aspiration_researches',
+        'null_move_tries', 'null_move_cutoffs',
+        'lmr_reductions', 'lmr_researches', 'futility_prunes',
+    )
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.depths = []
+        self.seconds = 0.0
+        self.book_move = False
+        self.cached_move = False
+
+    # Copy the searcher's counters
+    def update(self, searcher, seconds):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(searcher, name))
+        self.seconds = seconds
+
+    def record_depth(self, searcher, seconds):
+        previous = sum(depth.nodes for depth in self.depths)
+        self.update(searcher, seconds)
+        self.depths.append(DepthStats(searcher.completed_depth, searcher.score,
+                                      searcher.nodes - previous, seconds))
+
+    # Fraction of beta cutoffs caused by the first move searched
+    @property
+    def first_move_cutoff_rate(self):
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0
+
+    # Nodes of the last iteration over nodes of the one before
+    @property
+    def effective_branching_factor(self):
+        if len(self.depths) < 2 or self.depths[-2].nodes == 0:
+            return None
+        return self.depths[-1].nodes / self.depths[-2].nodes
+
+    @property
+    def nodes_per_second(self):
+        return self.nodes / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.COUNTERS}
+        result.update({
+            'seconds': self.seconds,
+            'book_move': self.book_move,
+            'cached_move': self.cached_move,
+            'depths': [depth._asdict() for depth in self.depths],
+            'first_move_cutoff_rate': self.first_move_cutoff_rate,
+            'effective_branching_factor': self.effective_branching_factor,
+            'nodes_per_second': self.nodes_per_second,
+        })
+        return result
+
+    def __str__(self):
+        if self.book_move:
+            return 'book move'
+        if self.cached_move:
+            return 'cached move'
+        ebf = self.effective_branching_factor
+        return 'nodes {} ({:.0f}/s)  evals {}  cutoffs {} ({:.0%} first move)  ebf {}'.format(
+            self.nodes, self.nodes_per_second, self.evaluations, self.cutoffs,
+            self.first_move_cutoff_rate, '-' if ebf is None else '{:.2f}'.format(ebf))
+
+
+class SearchTimeout(Exception):
+    pass
+
 class Card:
-    __slots__ = ['moves', 'start_player', 'name']
+    __slots__ = ['moves', 'masks', 'start_player', 'name']
 
     def __init__(self, moves, start_player, name):
         self.moves = moves
+        self.masks = tuple(
+            [sum(1 << end for end in ends) for ends in player_moves]
+            for player_moves in moves
+        )
         self.start_player = start_player
         self.name = name
 
+# Cards are never changed once made, so each is made once and shared
+_cards = dict()
+
+def create_card(card_name):
+    if card_name not in _cards:
+        _cards[card_name] = make_card(card_name)
+    return _cards[card_name]
+
 # In onitama.py, (x,y) coordinates are used to identify squares on the board
 # The AI uses integers with the conversion x + 5*y
 # This function translates the card data into that format
-def create_card(card_name):
+def make_card(card_name):
     card = oni.NAME_TO_CARD[card_name]
     # Start with a per-square representation of the card data using 2-tuple coordinates
     red_moves, blue_moves = dict(), dict()
@@ -432,3 +1015,26 @@ def convert_board(board):
         oni.Piece.B_KING: BLUEKING,
     }
     return [pieces[p] for p in board]
+
+def history_index(move):
+    return ((move.source+2)*25 + move.start)*125 + move.end*5 + move.card
+
+# The squares of RED's and BLUE's kings, None for a king not on the board
+def find_kings(board):
+    kings = [None, None]
+    for i, piece in enumerate(board):
+        if piece == REDKING:
+            kings[RED] = i
+        elif piece == BLUEKING:
+            kings[BLUE] = i
+    return kings
+
+# Bitboards (see top of file) for RED and BLUE, indexed by player
+def create_bitboards(board):
+    bitboards = [0, 0]
+    for i, piece in enumerate(board):
+        if piece > 0:
+            bitboards[RED] |= 1 << i
+        elif piece < 0:
+            bitboards[BLUE] |= 1 << i
+    return bitboards
@@ -1,8 +1,13 @@
 import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import onitama as oni
 import ai
 from constants import *
 from evaluators import *
+from transposition import *
 
 class TestGame(unittest.TestCase):
     def setUp(self):
@@ -41,23 +46,526 @@ class TestGame(unittest.TestCase):
                 len(list(filter(lambda x: x.end, a.get_nodes(depth=2)))), 4
             )
 
-    def test_piece_set(self):
-        def all_pieces():
-            return self.ai.pieces[REDPAWN]|self.ai.pieces[BLUEPAWN]|self.ai.pieces[REDKING]|self.ai.pieces[BLUEKING]
+    def test_perft_positions(self):
+        import profiler
+        self.assertEqual(profiler.check_perft(depth=3), [])
+
+    def test_kings(self):
+        for move in self.ai.next_moves():
+            self.ai.do_move(move, self.ai.root)
+            self.assertEqual(self.ai.kings, ai.find_kings(self.ai.board))
+            self.ai.undo_move(move)
+            self.assertEqual(self.ai.kings, ai.find_kings(self.ai.board))
+
+    def test_bitboards(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        self.ai.mock_search(depth=2)
         for move in self.ai.next_moves():
+            self.assertFalse(self.ai.bitboards[move.player] & 1 << move.end)
+            self.assertTrue(move.end in self.ai.card_data[move.card].moves[move.player][move.start])
             self.ai.do_move(move, self.ai.root)
-            # check pieces
-            for i, piece in enumerate(self.ai.board):
-                if piece != EMPTY:
-                    self.assertTrue(i in self.ai.pieces[piece])
-                else:
-                    i not in all_pieces()
+            self.assertEqual(self.ai.bitboards, ai.create_bitboards(self.ai.board))
             self.ai.undo_move(move)
-            for i, piece in enumerate(self.ai.board):
-                if piece != EMPTY:
-                    self.assertTrue(i in self.ai.pieces[piece])
-                else:
-                    i not in all_pieces()
+            self.assertEqual(self.ai.bitboards, ai.create_bitboards(self.ai.board))
+        self.assertEqual(len(self.ai.next_moves()), len(self.ai.root.children))
+
+    def test_zobrist_hash(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        start = self.ai.hash
+        for move in self.ai.next_moves():
+            self.ai.do_move(move, self.ai.root)
+            self.assertEqual(self.ai.hash, zobrist_hash(
+                self.ai.board, self.ai.cards, self.ai.card_data, self.ai.active_player))
+            for reply in self.ai.next_moves():
+                self.ai.do_move(reply, self.ai.root)
+                self.assertEqual(self.ai.hash, zobrist_hash(
+                    self.ai.board, self.ai.cards, self.ai.card_data, self.ai.active_player))
+                self.ai.undo_move(reply)
+            self.ai.undo_move(move)
+            self.assertEqual(self.ai.hash, start)
+
+    def test_transposition_table(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        plain = ai.MoveUnmoveAI(game, tt_bits=0)
+        self.ai.set_game_as_root(game)
+        self.ai.tt.clear()
+        inf = float('inf')
+        for depth in range(1, 5):
+            score = plain.alphabeta(alpha=-inf, beta=inf, node=plain.root, depth=depth)
+            tt_score = self.ai.alphabeta(alpha=-inf, beta=inf, node=self.ai.root, depth=depth)
+            self.assertEqual(score, tt_score)
+        entry = self.ai.tt.probe(self.ai.hash)
+        self.assertEqual(entry.depth, 4)
+        self.assertEqual(entry.move, self.ai.find_move(depth=4).code())
+
+    def test_shared_transposition_table(self):
+        import multiprocessing
+        import pickle
+        with SharedTranspositionTable(bits=8) as table:
+            table.store(0x1234, 3, LOWER, -float('inf'), 777)
+            table.store(0x5678, 0, EXACT, 0.07, 12)
+            self.assertEqual(table.probe(0x1234), Entry(0x1234, 3, LOWER, -float('inf'), 777, 0))
+            self.assertEqual(table.probe(0x5678).score, 0.07)
+            self.assertEqual(table.probe(0x1334), None)
+            # Entries written in another process are seen in this one
+            process = multiprocessing.get_context('spawn').Process(
+                target=table.store, args=(0x9abc, 5, UPPER, 1.5, 42))
+            process.start()
+            process.join()
+            self.assertEqual(table.probe(0x9abc), Entry(0x9abc, 5, UPPER, 1.5, 42, 0))
+            attached = pickle.loads(pickle.dumps(table))
+            self.assertEqual(attached.probe(0x5678).move, 12)
+            # A slot half overwritten fails its check
+            attached.buffer[HEADER.size + (0x5678 & table.mask) * SLOT.size + 9] ^= 1
+            self.assertEqual(table.probe(0x5678), None)
+            attached.close()
+            # Searching with it is the same as with a private table of the same size
+            table.clear()
+            game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+            private = ai.MoveUnmoveAI(game, tt_bits=8)
+            shared = ai.MoveUnmoveAI(game, tt=table)
+            self.assertEqual(private.find_move(depth=4).code(), shared.find_move(depth=4).code())
+            self.assertEqual((private.score, private.nodes), (shared.score, shared.nodes))
+            self.assertEqual(table.generation, 1)
+
+    def test_analysis_cache(self):
+        import os
+        import tempfile
+        import cache
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'analysis.bin')
+            with cache.AnalysisCache(path, bits=2) as analysis:
+                size = os.path.getsize(path)
+                # Five keys for one bucket: the least recently used is evicted
+                for key in [4, 8, 12, 16]:
+                    analysis.put(key, key, 3, 0.5)
+                self.assertEqual(analysis.get(4), (4, 3, 0.5))
+                analysis.put(20, 20, 3, 0.5)
+                self.assertEqual([analysis.get(key) is None for key in [4, 8, 12, 16, 20]],
+                                 [False, True, False, False, False])
+                # Deeper results replace shallower ones, not the other way round
+                analysis.put(4, 5, 2, 0.25)
+                analysis.put(12, 6, 4, 0.75)
+                self.assertEqual((analysis.get(4), analysis.get(12)), ((4, 3, 0.5), (6, 4, 0.75)))
+                self.assertEqual(len(analysis), 4)
+                searcher = ai.MoveUnmoveAI(oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS]),
+                                           cache=analysis)
+                move = searcher.find_move(depth=3)
+                score = searcher.score
+            self.assertEqual(os.path.getsize(path), size)
+            # After a restart, the position is answered from the file, whatever the order of start_cards
+            with cache.AnalysisCache(path) as analysis:
+                self.assertEqual(analysis.bits, 2)
+                game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+                searcher = ai.MoveUnmoveAI(game, cache=analysis)
+                self.assertEqual(searcher.find_move(depth=3).code(), move.code())
+                self.assertEqual((searcher.stats.cached_move, searcher.stats.nodes, searcher.score),
+                                 (True, 0, score))
+                reordered = ai.MoveUnmoveAI(oni.Game([oni.MONKEY, oni.TIGER, oni.BOAR, oni.CRAB, oni.MANTIS]),
+                                            cache=analysis)
+                self.assertEqual(reordered.create_game_move(reordered.find_move(depth=2)).notation(),
+                                 searcher.create_game_move(move).notation())
+                self.assertTrue(reordered.stats.cached_move)
+                # A deeper search starts from the cached move and replaces the entry
+                searcher.find_move(depth=4)
+                self.assertFalse(searcher.stats.cached_move)
+                self.assertEqual(analysis.lookup(searcher)[1][1:], (4, searcher.score))
+
+    def test_iterative_deepening(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        move = self.ai.find_move(max_depth=3)
+        self.assertEqual(self.ai.completed_depth, 3)
+        self.assertEqual(move.code(), self.ai.find_move(depth=3).code())
+        board, cards = self.ai.board[:], self.ai.cards[:]
+        move = self.ai.find_move(time_limit=0.2)
+        self.assertTrue(move is not None)
+        self.assertTrue(1 <= self.ai.completed_depth < ai.DEFAULT_MAX_DEPTH)
+        # An abandoned iteration leaves the position as it was
+        self.assertEqual((board, cards), (self.ai.board, self.ai.cards))
+        self.assertEqual(self.ai.hash, zobrist_hash(board, cards, self.ai.card_data, self.ai.active_player))
+
+    def test_stop_and_progress(self):
+        import threading
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        stop = threading.Event()
+        depths = []
+        def progress(searcher):
+            depths.append(searcher.completed_depth)
+            if searcher.completed_depth == 3:
+                stop.set()
+        move = self.ai.find_move(max_depth=10, stop=stop, progress=progress)
+        self.assertEqual(depths, [1, 2, 3])
+        self.assertEqual(move.code(), self.ai.find_move(depth=3).code())
+        # Stopped from another thread during a long search
+        stop = threading.Event()
+        threading.Timer(0.2, stop.set).start()
+        move = self.ai.find_move(max_depth=ai.DEFAULT_MAX_DEPTH, stop=stop)
+        self.assertTrue(move is not None)
+        self.assertTrue(self.ai.completed_depth < ai.DEFAULT_MAX_DEPTH)
+        # Stopped before it started
+        self.assertIsNone(self.ai.find_move(depth=3, stop=stop))
+        self.assertIsNone(self.ai.stop_event)
+
+    def test_search_stats(self):
+        import json
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        self.ai.find_move(depth=5)
+        stats = self.ai.stats
+        self.assertEqual([depth.depth for depth in stats.depths], [1, 2, 3, 4, 5])
+        self.assertEqual(sum(depth.nodes for depth in stats.depths), stats.nodes)
+        self.assertEqual(stats.depths[-1].score, self.ai.score)
+        self.assertEqual((stats.nodes, stats.cutoffs), (self.ai.nodes, self.ai.cutoffs))
+        self.assertTrue(0 < stats.evaluations <= stats.nodes)
+        self.assertTrue(0 < stats.first_move_cutoff_rate <= 1)
+        self.assertAlmostEqual(stats.effective_branching_factor, stats.depths[-1].nodes/stats.depths[-2].nodes)
+        self.assertTrue(all(a.seconds <= b.seconds for a, b in zip(stats.depths, stats.depths[1:])))
+        self.assertTrue(stats.depths[-1].seconds <= stats.seconds)
+        self.assertEqual(json.loads(json.dumps(stats.as_dict()))['nodes'], stats.nodes)
+        self.assertIn('nodes {}'.format(stats.nodes), str(stats))
+        # A new search starts from zero
+        self.ai.find_move(depth=1)
+        self.assertEqual(len(self.ai.stats.depths), 1)
+        self.assertTrue(self.ai.stats.nodes < stats.nodes)
+        self.assertIsNone(self.ai.stats.effective_branching_factor)
+
+    def test_tree_free_search(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        plain = ai.MoveUnmoveAI(game, tt_bits=0)
+        lean = ai.MoveUnmoveAI(game, tt_bits=0)
+        inf = float('inf')
+        for depth in range(1, 5):
+            score = plain.alphabeta(alpha=-inf, beta=inf, node=plain.root, depth=depth)
+            self.assertEqual(lean.search(-inf, inf, depth), score)
+            self.assertEqual(lean.best_move.code(), plain.best_move.code())
+            self.assertEqual(lean.root_scores[lean.best_move.code()], score)
+            self.assertEqual(lean.root.children, [])
+        move = lean.find_move(depth=4)
+        self.assertEqual(lean.principal_variation[0], move)
+        # Replaying the principal variation reaches a position scored as the search said
+        for ply in lean.principal_variation:
+            lean.make_move(ply)
+        leaf = lean.evaluate_current()
+        for ply in reversed(lean.principal_variation):
+            lean.undo_move(ply)
+        sign = 1 if len(lean.principal_variation) % 2 == 0 else -1
+        self.assertEqual(sign*leaf, lean.score)
+
+    def test_killers_and_history(self):
+        game = oni.Game([oni.DRAGON, oni.ROOSTER, oni.GOOSE, oni.OX, oni.CRAB])
+        plain = ai.MoveUnmoveAI(game, killer_moves=False, history_heuristic=False)
+        ordered = ai.MoveUnmoveAI(game)
+        plain.find_move(depth=5)
+        ordered.find_move(depth=5)
+        self.assertEqual(plain.score, ordered.score)
+        self.assertTrue(ordered.nodes < plain.nodes)
+        self.assertTrue(ordered.first_move_cutoffs <= ordered.cutoffs)
+        self.assertTrue(any(killers[0] is not None for killers in ordered.killers))
+        self.assertTrue(any(ordered.history))
+        self.assertFalse(any(plain.history))
+        # Killers come straight after captures
+        killer = ordered.killers[1][0]
+        ordered.make_move(ordered.best_move)
+        moves = list(ordered.move_selector(ordered.next_moves(), ordered.active_player, ply=1))
+        quiet = [move.code() for move in moves if move.target == EMPTY]
+        ordered.undo_move(ordered.best_move)
+        if killer in quiet:
+            self.assertEqual(quiet[0], killer)
+
+    def test_pvs_and_aspiration(self):
+        game = oni.Game([oni.DRAGON, oni.ROOSTER, oni.GOOSE, oni.OX, oni.CRAB])
+        scores = set()
+        for algorithm in ai.ALGORITHMS:
+            for aspiration in [None, 0.01, 0.25]:
+                searcher = ai.MoveUnmoveAI(game, algorithm=algorithm, aspiration=aspiration)
+                searcher.find_move(depth=5)
+                scores.add(searcher.score)
+        self.assertEqual(len(scores), 1)
+        searcher = ai.MoveUnmoveAI(game, algorithm='pvs', aspiration=0.001)
+        searcher.find_move(depth=5)
+        self.assertTrue(searcher.pvs_researches > 0)
+        self.assertTrue(searcher.aspiration_researches > 0)
+        with self.assertRaises(ValueError):
+            ai.MoveUnmoveAI(game, algorithm='mtdf')
+
+    def test_forward_pruning(self):
+        game = oni.Game([oni.DRAGON, oni.ROOSTER, oni.GOOSE, oni.OX, oni.CRAB])
+        plain = ai.MoveUnmoveAI(game)
+        plain.find_move(depth=6)
+        self.assertEqual(plain.null_move_tries + plain.lmr_reductions + plain.futility_prunes, 0)
+        searchers = {
+            'null_move': ai.MoveUnmoveAI(game, null_move=True),
+            'late_move_reductions': ai.MoveUnmoveAI(game, late_move_reductions=True),
+            'futility': ai.MoveUnmoveAI(game, futility=True),
+        }
+        for searcher in searchers.values():
+            move = searcher.find_move(depth=6)
+            self.assertTrue(move.code() in [m.code() for m in plain.next_moves()])
+            self.assertTrue(abs(searcher.score) < float('inf'))
+        self.assertTrue(searchers['null_move'].null_move_tries > 0)
+        self.assertTrue(searchers['null_move'].null_move_cutoffs <= searchers['null_move'].null_move_tries)
+        self.assertTrue(searchers['late_move_reductions'].lmr_reductions > 0)
+        self.assertTrue(searchers['futility'].futility_prunes > 0)
+        for searcher in searchers.values():
+            self.assertTrue(searcher.nodes < plain.nodes)
+        # Forced wins are still found with everything switched on
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        game.board.array = [oni.Piece.EMPTY]*25
+        game.board.array[0] = oni.Piece.R_PAWN
+        game.board.array[6] = oni.Piece.R_KING
+        game.board.array[12] = oni.Piece.B_KING
+        game.board.array[24] = oni.Piece.B_PAWN
+        searcher = ai.MoveUnmoveAI(game, null_move=True, late_move_reductions=True, futility=True)
+        searcher.find_move(depth=3)
+        self.assertEqual(searcher.score, float('inf'))
+
+    def test_parallel_search(self):
+        from parallel import ParallelAI
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        plain = ai.MoveUnmoveAI(game, tt_bits=0)
+        inf = float('inf')
+        score = plain.alphabeta(alpha=-inf, beta=inf, node=plain.root, depth=3)
+        with ParallelAI(game, workers=2) as searcher:
+            move = searcher.find_move(depth=3)
+            self.assertEqual(searcher.score, score)
+            self.assertTrue(move.code() in [m.code() for m in plain.next_moves()])
+            # Each search ages the table, so its entries can be replaced by the next
+            searcher.find_move(depth=3)
+            self.assertEqual(searcher.table.generation, 2)
+
+    def test_arena(self):
+        import arena
+        self.assertEqual(arena.parse_engine('depth=2, algorithm=pvs,mobility_weight=0.02'),
+                         {'depth': 2, 'algorithm': 'pvs', 'mobility_weight': 0.02})
+        tasks = arena.schedule(4, seed=1, random_plies=2)
+        self.assertEqual([task['a_red'] for task in tasks], [True, False, True, False])
+        self.assertEqual(tasks[0]['cards'], tasks[1]['cards'])
+        cards = ['tiger', 'monkey', 'crab', 'boar', 'mantis']
+        tasks = arena.schedule(2, seed=1, cards=cards, random_plies=2)
+        results = list(arena.play(tasks, {'depth': 1}, {'depth': 2, 'mobility_weight': 0.02}, workers=1))
+        self.assertEqual(sorted(result['game'] for result in results), [0, 1])
+        for result in results:
+            self.assertEqual(result['cards'], cards)
+            self.assertIn(result['winner'], ['a', 'b', None])
+            game = oni.Game([oni.NAME_TO_CARD[name] for name in cards])
+            for move in oni.Move.parse_moves(game.active_player, result['moves']):
+                game.do_move(move)
+            self.assertEqual(len(game.moves), result['plies'])
+        # Same opening in both games of a pair
+        self.assertEqual(results[0]['moves'].split(' ')[:4], results[1]['moves'].split(' ')[:4])
+        summary = arena.summarize([{'winner': 'a'}]*6 + [{'winner': None}]*2 + [{'winner': 'b'}]*2)
+        self.assertEqual((summary['wins'], summary['draws'], summary['losses']), (6, 2, 2))
+        self.assertAlmostEqual(summary['score'], 0.7)
+        self.assertAlmostEqual(summary['elo'], 147.19, places=2)
+        low, high = summary['elo_interval']
+        self.assertTrue(low < summary['elo'] < high)
+        self.assertEqual(arena.summarize([{'winner': None}])['elo'], 0)
+
+    def test_engine(self):
+        import engine
+        lines = []
+        server = engine.Engine(lines.append, tt_bits=16)
+        for command in ['onitama', 'isready', 'go depth 2', 'position cards tiger monkey crab boar',
+                        'position cards tiger monkey crab boar mantis moves c1-c2 [tiger]',
+                        'position cards tiger monkey crab boar mantis moves c1-c3 [tiger]', 'go depth 3']:
+            server.handle(command)
+        server.stop()
+        self.assertEqual(lines[:3], ['id name onitama', 'onitamaok', 'readyok'])
+        self.assertEqual([line.startswith('info string error') for line in lines[3:6]], [True]*3)
+        infos = [line.split() for line in lines[6:] if line.startswith('info depth')]
+        self.assertEqual([int(words[2]) for words in infos], [1, 2, 3])
+        self.assertTrue(lines[-1].startswith('bestmove '))
+        game = engine.parse_position('cards tiger monkey crab boar mantis moves c1-c3 [tiger]'.split())
+        move = oni.Move.parse_moves(game.active_player, lines[-1][len('bestmove '):])[0]
+        self.assertTrue(game.validate_move(move))
+        # The table is kept between searches, so a second search costs less
+        nodes = server.ai.stats.nodes
+        server.handle('go depth 3')
+        server.stop()
+        self.assertTrue(server.ai.stats.nodes < nodes)
+        # stop ends an infinite search with a move
+        del lines[:]
+        server.handle('go infinite')
+        server.handle('stop')
+        self.assertTrue(lines[-1].startswith('bestmove '))
+        # A position that fails to parse is not replaced by the previous one
+        server.handle('position cards tiger monkey crab boar mantis moves c5-c3 [tiger]')
+        server.handle('go movetime 200')
+        server.stop()
+        self.assertEqual(lines[-2:], ['info string error: illegal move: c5-c3 [tiger]',
+                                      'info string error: no position'])
+        self.assertFalse(server.handle('quit'))
+
+    def test_server(self):
+        import asyncio
+        import json
+        import server
+        cards = ['tiger', 'monkey', 'crab', 'boar', 'mantis']
+        requests = [
+            {'id': 1, 'cards': cards, 'moves': 'c1-c3 [tiger]', 'depth': 3},
+            {'id': 2, 'cards': cards, 'moves': 'c1-c3  [tiger]', 'depth': 3},
+            {'id': 3, 'cards': cards, 'depth': 2},
+            {'id': 4, 'cards': cards[:4]},
+        ]
+        async def client(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode() + b'{"id": 5\n')
+            writer.write_eof()
+            replies = [json.loads(line) for line in (await reader.read()).decode().splitlines()]
+            writer.close()
+            return replies
+        async def run():
+            analysis = server.AnalysisServer(workers=1, max_pending=1)
+            listener = await analysis.start(port=0)
+            try:
+                replies = await client(listener.sockets[0].getsockname()[1])
+            finally:
+                await analysis.close()
+            return analysis, replies
+        analysis, replies = asyncio.run(run())
+        by_id = {i: [reply for reply in replies if reply['id'] == i] for i in [None, 1, 2, 3, 4]}
+        self.assertEqual(by_id[4], [{'id': 4, 'type': 'error', 'error': 'expected five card names'}])
+        self.assertEqual(by_id[None], [{'id': None, 'type': 'error', 'error': 'not JSON'}])
+        # With max_pending=1, 3 is not read until the search for 1 and 2 is done,
+        # and 4 is answered as soon as 3 has its slot, before 3's search has started
+        self.assertTrue(replies.index(by_id[1][-1]) < replies.index(by_id[3][0]))
+        self.assertTrue(replies.index(by_id[4][0]) < replies.index(by_id[3][0]))
+        self.assertEqual([reply['depth'] for reply in by_id[1]], [1, 2, 3, 3])
+        self.assertEqual([reply['type'] for reply in by_id[3]], ['depth', 'depth', 'result'])
+        # 2 is the same position as 1, so they share one search
+        self.assertEqual((analysis.requests, analysis.searches), (3, 2))
+        self.assertEqual([dict(reply, id=1) for reply in by_id[2]], by_id[1])
+        game = oni.Game([oni.NAME_TO_CARD[name] for name in cards])
+        game.do_move(oni.Move.parse_moves(game.active_player, 'c1-c3 [tiger]')[0])
+        move = oni.Move.parse_moves(game.active_player, by_id[1][-1]['move'])[0]
+        self.assertTrue(game.validate_move(move))
+
+    def test_tablebase(self):
+        import os, tempfile, tablebase
+        names = ['tiger', 'monkey', 'crab', 'boar', 'mantis']
+        cards = [oni.NAME_TO_CARD[name] for name in names]
+        values = tablebase.generate(names, max_pieces=1)
+        with self.assertRaises(tablebase.TableBaseError):
+            tablebase.generate(names[:4] + names[:1], max_pieces=1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'kings.tb')
+            tablebase.write(path, names, 1, values)
+            table = tablebase.TableBase(path)
+        inf = float('inf')
+        checked = 0
+        for index, value in enumerate(table.values):
+            if not 3 <= value <= 5 or index % 97:
+                continue
+            (red_king, blue_king, _, _), (red, blue, neutral), player = table.indexer.position(index)
+            # Kings only, placed by hand
+            game = oni.Game(cards)
+            game.board.array = [oni.Piece.EMPTY]*25
+            game.board.array[red_king] = oni.Piece.R_KING
+            game.board.array[blue_king] = oni.Piece.B_KING
+            game.cards = {
+                oni.Player.RED: [cards[i] for i in red],
+                oni.Player.BLUE: [cards[i] for i in blue],
+            }
+            game.neutral_card = cards[neutral]
+            game.active_player = oni.Player.RED if player == RED else oni.Player.BLUE
+            plain = ai.MoveUnmoveAI(game, tt_bits=0)
+            distance = value - 1
+            self.assertEqual(table.probe(plain), tablebase.TB_WIN - distance if distance % 2 else distance - tablebase.TB_WIN)
+            score = plain.alphabeta(alpha=-inf, beta=inf, node=plain.root, depth=distance)
+            self.assertEqual(score, inf if distance % 2 else -inf)
+            probing = ai.MoveUnmoveAI(game, tt_bits=0, tablebase=table)
+            score = probing.alphabeta(alpha=-inf, beta=inf, node=probing.root, depth=1)
+            self.assertTrue(abs(score) > tablebase.TB_WIN - distance - 1)
+            checked += 1
+        self.assertTrue(checked > 10)
+        table.close()
+        # Taking moves back finds exactly the positions with a move to a position
+        indexer = tablebase.Indexer(max_pieces=2)
+        card_data = [ai.create_card(name) for name in names]
+        for index in range(0, len(indexer), 99991):
+            for successor in tablebase.successors(indexer, card_data, index) or []:
+                self.assertTrue(index in tablebase.predecessors(indexer, card_data, successor))
+            for predecessor in tablebase.predecessors(indexer, card_data, index):
+                moves = tablebase.successors(indexer, card_data, predecessor)
+                self.assertTrue(moves is None or index in moves)
+
+    def test_opening_book(self):
+        import os, tempfile, book
+        cards = [oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS]
+        self.assertEqual(len(list(book.card_set_classes(cards))), 30)
+        entries = book.build([cards], plies=2, depth=2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'book.bin')
+            book.write(path, entries)
+            opening = book.Book(path)
+        self.assertEqual(len(opening), len(entries))
+        for key, entry in entries.items():
+            self.assertEqual(opening.get(key)[:2], entry[:2])
+        self.assertEqual(opening.get(0), None)
+        # Hands in the other order give the same positions
+        game = oni.Game([oni.MONKEY, oni.TIGER, oni.BOAR, oni.CRAB, oni.MANTIS])
+        # A position out of the book is searched first: its counts and line
+        # must not be reported for the book move
+        booked = ai.MoveUnmoveAI(oni.Game([oni.DRAGON, oni.ROOSTER, oni.GOOSE, oni.OX, oni.CRAB]), book=opening)
+        booked.find_move(depth=2)
+        self.assertTrue(booked.nodes > 0)
+        booked.set_game_as_root(game)
+        move = booked.find_move(depth=2)
+        self.assertEqual(booked.nodes, 0)
+        self.assertEqual(booked.principal_variation, [move])
+        searched = ai.MoveUnmoveAI(game).find_move(depth=2)
+        self.assertEqual((move.start, move.end), (searched.start, searched.end))
+        opening.close()
+
+    def test_symmetry(self):
+        import os, tempfile, book, symmetry
+        self.assertEqual({name: mirror for name, mirror in symmetry.MIRROR_CARD.items() if name != mirror}, {
+            'frog': 'rabbit', 'rabbit': 'frog', 'goose': 'rooster', 'rooster': 'goose',
+            'eel': 'cobra', 'cobra': 'eel', 'horse': 'ox', 'ox': 'horse'})
+        cards = [oni.GOOSE, oni.OX, oni.EEL, oni.TIGER, oni.CRAB]
+        mirrored = [oni.ROOSTER, oni.HORSE, oni.COBRA, oni.TIGER, oni.CRAB]
+        # All four forms of a position share one key, and the transform
+        # returned takes each to the canonical position
+        searcher = ai.MoveUnmoveAI(oni.Game(cards))
+        for move in searcher.next_moves():
+            searcher.make_move(move)
+            board = searcher.board
+            names = [searcher.card_data[card].name for card in searcher.cards]
+            key, transform = symmetry.canonical(board, names, searcher.active_player)
+            self.assertEqual(symmetry.canonical_position(searcher)[0], key)
+            canonical_board = symmetry.transform_position(board, names, searcher.active_player, *transform)[0]
+            self.assertEqual(tuple(canonical_board), key[0])
+            for swap in (False, True):
+                for mirror in (False, True):
+                    other = symmetry.transform_position(board, names, searcher.active_player, swap, mirror)
+                    self.assertEqual(symmetry.canonical(*other)[0], key)
+                    self.assertEqual(symmetry.transform_position(*other, swap, mirror), (board, names, searcher.active_player))
+            searcher.undo_move(move)
+        # Mirror images search to the same score
+        inf = float('inf')
+        scores = []
+        for start_cards in [cards, mirrored]:
+            searcher = ai.MoveUnmoveAI(oni.Game(start_cards), tt_bits=0)
+            scores.append(searcher.alphabeta(-inf, inf, searcher.root, 4))
+        self.assertEqual(scores[0], scores[1])
+        # A book built for one card set answers for its mirror image
+        entries = book.build([cards], plies=1, depth=2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'book.bin')
+            book.write(path, entries)
+            opening = book.Book(path)
+        moves = []
+        for start_cards in [cards, mirrored]:
+            booked = ai.MoveUnmoveAI(oni.Game(start_cards), book=opening)
+            moves.append(booked.find_move(depth=2))
+            self.assertEqual(booked.nodes, 0)
+        self.assertEqual(symmetry.transform_square(moves[0].start, False, True), moves[1].start)
+        self.assertEqual(symmetry.transform_square(moves[0].end, False, True), moves[1].end)
+        opening.close()
 
     def test_mobility_eval(self):
         game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
@@ -76,6 +584,59 @@ class TestGame(unittest.TestCase):
         self.assertEqual(eval.evaluate(RED), 3.0)
         self.assertEqual(eval.evaluate(BLUE), -3.0)
 
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_batch_evaluator(self):
+        batch = BatchEvaluator(pawn_weight=1.5, mobility_weight=0.02, true_mobility_factor=2.0)
+        rows, expected = [], []
+        for cards in [[oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS],
+                      [oni.DRAGON, oni.ROOSTER, oni.GOOSE, oni.OX, oni.CRAB]]:
+            self.ai.set_game_as_root(oni.Game(cards))
+            eval = get_evaluator(self.ai)
+            eval.pawn_weight, eval.mobility_weight, eval.true_mobility_factor = 1.5, 0.02, 2.0
+            # Every position up to three plies ahead, including won ones
+            def walk(depth):
+                rows.append(batch_row(self.ai))
+                expected.append(eval.evaluate(self.ai.active_player))
+                if depth == 0 or self.ai.root.end:
+                    return
+                for move in self.ai.next_moves():
+                    self.ai.do_move(move, self.ai.root)
+                    walk(depth-1)
+                    self.ai.undo_move(move)
+            walk(3)
+        boards, card_indices, players = zip(*rows)
+        scores = batch.evaluate(numpy.array(boards, dtype=numpy.int8), numpy.array(card_indices),
+                                numpy.array(players))
+        self.assertEqual(scores.shape, (len(rows),))
+        self.assertTrue(any(abs(score) == float('inf') for score in expected))
+        for score, value in zip(scores, expected):
+            if abs(value) == float('inf'):
+                self.assertEqual(score, value)
+            else:
+                self.assertAlmostEqual(score, value)
+        # A single player for the whole batch
+        red = batch.evaluate(boards[:10], card_indices[:10], RED)
+        blue = batch.evaluate(boards[:10], card_indices[:10], BLUE)
+        self.assertTrue(all(r == -b for r, b in zip(red, blue)))
+
+    def test_incremental_mobility(self):
+        game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
+        self.ai.set_game_as_root(game)
+        full = get_evaluator(self.ai)
+        cached = get_evaluator(self.ai, incremental=True)
+        def check(depth):
+            self.assertAlmostEqual(full.mobility(), cached.mobility())
+            self.assertAlmostEqual(full.evaluate(self.ai.active_player), self.ai.evaluate_current())
+            if depth == 0:
+                return
+            for move in self.ai.next_moves():
+                self.ai.do_move(move, self.ai.root)
+                check(depth-1)
+                self.ai.undo_move(move)
+        start = [counts[:] for counts in self.ai.mobility]
+        check(3)
+        self.assertEqual(start, self.ai.mobility)
+
     def test_negamax(self):
         game = oni.Game([oni.TIGER, oni.MONKEY, oni.CRAB, oni.BOAR, oni.MANTIS])
         self.ai.set_game_as_root(game)
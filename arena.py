@@ -0,0 +1,225 @@
+'''
+Engine-vs-engine arena: plays games between two MoveUnmoveAI configurations
+
+Engines are described by comma separated key=value options:
+    depth, time_limit, max_depth         passed to find_move
+    pawn_weight, mobility_weight,
+    true_mobility_factor                 passed to the Evaluator
+    anything else                        passed to MoveUnmoveAI, e.g. algorithm=pvs
+Values are Python literals (4, 0.5, True, None), anything else is a string.
+
+Games are played in pairs with the same start cards (and opening moves, with
+--random-plies), each engine taking red in one game of the pair. Start cards
+are drawn at random, or fixed with --cards. Games are spread over a process pool,
+and each result is written to the output file as one line of JSON as soon as
+it is in, so a long run can be watched or summarized before it finishes:
+
+    python arena.py -a depth=4 -b depth=4,algorithm=pvs --games 1000 -o results.jsonl
+    python arena.py --report results.jsonl
+
+Results are reported from engine a's point of view: wins, draws and losses,
+its score (wins plus half the draws, per game) and the Elo difference that
+score implies, each with a 95% confidence interval.
+'''
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import math
+import os
+import random
+import sys
+import onitama as oni
+import ai
+
+SEARCH_OPTIONS = ('depth', 'time_limit', 'max_depth')
+EVALUATOR_OPTIONS = ('pawn_weight', 'mobility_weight', 'true_mobility_factor')
+DEFAULT_ENGINE = {'depth': 4}
+
+# Games longer than this many plies are drawn
+MAX_PLIES = 200
+
+# Two-sided 95% normal quantile
+Z95 = 1.959964
+
+# 'depth=4,algorithm=pvs' -> {'depth': 4, 'algorithm': 'pvs'}
+def parse_engine(text):
+    engine = dict()
+    for item in filter(None, text.split(',')):
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError('expected key=value: {}'.format(item))
+        try:
+            engine[key.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            engine[key.strip()] = value.strip()
+    return engine
+
+def create_engine(engine):
+    options = {key: value for key, value in engine.items()
+               if key not in SEARCH_OPTIONS and key not in EVALUATOR_OPTIONS}
+    options['evaluator_options'] = {key: value for key, value in engine.items()
+                                    if key in EVALUATOR_OPTIONS}
+    search = {key: value for key, value in engine.items() if key in SEARCH_OPTIONS}
+    if not search:
+        search = dict(DEFAULT_ENGINE)
+    return ai.MoveUnmoveAI(**options), search
+
+# Tasks for games numbers start..start+count-1, as dicts of picklable values
+# Game 2k and 2k+1 share cards and opening, and a has red in the even game
+def schedule(count, seed, cards=None, random_plies=0, start=0):
+    tasks = []
+    for number in range(start, start+count):
+        pair = number // 2
+        rng = random.Random('{}-{}'.format(seed, pair))
+        card_names = cards or [card.name() for card in rng.sample(oni.ALL_CARDS, 5)]
+        tasks.append({
+            'game': number,
+            'cards': list(card_names),
+            'a_red': number % 2 == 0,
+            'opening_seed': '{}-{}'.format(seed, pair),
+            'random_plies': random_plies,
+        })
+    return tasks
+
+# Runs in a worker: play one game and return its result
+# winner is 'a', 'b' or None for a draw
+def play_game(task, engine_a, engine_b, max_plies=MAX_PLIES):
+    game = oni.Game([oni.NAME_TO_CARD[name] for name in task['cards']])
+    rng = random.Random(task['opening_seed'])
+    for _ in range(task['random_plies']):
+        choices = sorted(
+            (start, end, card.name())
+            for card, targets in game.legal_moves().items()
+            for start, ends in targets.items() for end in ends)
+        if not choices or game.check_victory() is not None:
+            break
+        start, end, name = rng.choice(choices)
+        game.do_move(oni.Move(game.active_player, start, end, oni.NAME_TO_CARD[name]))
+    red, blue = (engine_a, engine_b) if task['a_red'] else (engine_b, engine_a)
+    engines = {
+        oni.Player.RED: create_engine(red),
+        oni.Player.BLUE: create_engine(blue),
+    }
+    winner, reason = None, 'max plies'
+    while len(game.moves) < max_plies:
+        victor = game.check_victory()
+        if victor is not None:
+            winner, reason = victor, 'victory'
+            break
+        searcher, search = engines[game.active_player]
+        searcher.set_game_as_root(game)
+        move = searcher.find_move(**search)
+        if move is None:
+            # No legal moves: lost, as in the search
+            winner, reason = game.active_player.other(), 'no moves'
+            break
+        game.do_move(searcher.create_game_move(move))
+    if winner is not None:
+        red_won = winner == oni.Player.RED
+        winner = 'a' if red_won == task['a_red'] else 'b'
+    return dict(task, winner=winner, reason=reason, plies=len(game.moves),
+                moves=oni.Move.format_moves(game.moves))
+
+# Play the tasks, yielding results as they finish
+def play(tasks, engine_a, engine_b, workers=None, max_plies=MAX_PLIES):
+    workers = workers if workers is not None else os.cpu_count()
+    if workers <= 1:
+        for task in tasks:
+            yield play_game(task, engine_a, engine_b, max_plies)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(play_game, task, engine_a, engine_b, max_plies) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+def elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return 400 * math.log10(score / (1 - score))
+
+# Win/draw/loss counts for engine a, its score and Elo difference,
+# with 95% confidence intervals from the normal approximation
+def summarize(results):
+    wins = draws = losses = 0
+    for result in results:
+        if result['winner'] == 'a':
+            wins += 1
+        elif result['winner'] == 'b':
+            losses += 1
+        else:
+            draws += 1
+    games = wins + draws + losses
+    summary = {'games': games, 'wins': wins, 'draws': draws, 'losses': losses}
+    if games == 0:
+        return summary
+    score = (wins + draws/2) / games
+    variance = (wins*(1 - score)**2 + draws*(0.5 - score)**2 + losses*score**2) / games
+    margin = Z95 * math.sqrt(variance / games)
+    summary.update({
+        'win_rate': wins/games,
+        'draw_rate': draws/games,
+        'loss_rate': losses/games,
+        'score': score,
+        'score_interval': (max(score - margin, 0), min(score + margin, 1)),
+        'elo': elo(score),
+        'elo_interval': (elo(score - margin), elo(score + margin)),
+    })
+    return summary
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def format_summary(summary):
+    if summary['games'] == 0:
+        return 'no games'
+    return ('{games} games: +{wins} ={draws} -{losses}  score {score:.3f} '
+            '[{low:.3f}, {high:.3f}]  elo {elo:+.1f} [{elo_low:+.1f}, {elo_high:+.1f}]').format(
+        low=summary['score_interval'][0], high=summary['score_interval'][1],
+        elo_low=summary['elo_interval'][0], elo_high=summary['elo_interval'][1], **summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play two AI configurations against each other')
+    parser.add_argument('-a', '--engine-a', type=parse_engine, default=dict(DEFAULT_ENGINE),
+                        help='options for engine a, e.g. depth=4,algorithm=pvs')
+    parser.add_argument('-b', '--engine-b', type=parse_engine, default=dict(DEFAULT_ENGINE),
+                        help='options for engine b')
+    parser.add_argument('--games', type=int, default=100, help='number of games, best even')
+    parser.add_argument('--cards', nargs=5, help='play every game with these five cards')
+    parser.add_argument('--random-plies', type=int, default=0,
+                        help='random moves played at the start of each pair of games')
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES, help='longer games are drawn')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='append results to this file, one JSON line per game')
+    parser.add_argument('--report', metavar='FILE', help='only summarize a results file')
+    args = parser.parse_args(argv)
+
+    if args.report:
+        print(format_summary(summarize(read_results(args.report))))
+        return 0
+    cards = [name.lower() for name in args.cards] if args.cards else None
+    tasks = schedule(args.games, args.seed, cards, args.random_plies)
+    output = open(args.output, 'a') if args.output else None
+    results = []
+    try:
+        for result in play(tasks, args.engine_a, args.engine_b, args.workers, args.max_plies):
+            results.append(result)
+            if output is not None:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+            print('\r' + format_summary(summarize(results)), end='', file=sys.stderr)
+    finally:
+        if output is not None:
+            output.close()
+        print(file=sys.stderr)
+    print(format_summary(summarize(results)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+'''
+Opening book: best moves for the first plies of a game, found offline by deep searches
+
+Every game starts from the same board, so the positions in the first few plies
+depend only on the card assignment: red's pair and blue's pair (in either
+order) and the neutral card. card_set_classes lists one start_cards
+ordering per such assignment.
+
+Positions are keyed by the Zobrist hash of their canonical form (see
+symmetry.py), so a position, its mirror image and its colour-swapped form
+share one entry, and the hash is the same for every ordering of start_cards
+within a class. Moves are stored for the canonical position as
+start | end << 5 | card << 10, with card an index into onitama.ALL_CARDS, and
+taken back to the real position on lookup.
+
+File layout: MAGIC, a uint32 entry count, then fixed-size entries sorted by key
+(key, move, depth, score). Lookups binary search the memory-mapped entries.
+
+    python book.py --plies 2 --depth 7 -o book.bin tiger monkey crab boar mantis
+'''
+import argparse
+from itertools import combinations
+import mmap
+import random
+import struct
+import sys
+import onitama as oni
+import ai
+from parallel import game_spec, game_from_spec
+from symmetry import MIRROR_CARD, canonical_position, canonical_hash, transform_square
+
+MAGIC = b'ONIBK\x00\x02\x00'
+ENTRY = struct.Struct('<QHBxf')
+
+# One start_cards list per card assignment: [red, red, blue, blue, neutral],
+# each pair in ALL_CARDS order
+def card_set_classes(cards=oni.ALL_CARDS):
+    for five in combinations(cards, 5):
+        for neutral in five:
+            hands = [card for card in five if card is not neutral]
+            for red in combinations(hands, 2):
+                blue = [card for card in hands if card not in red]
+                yield list(red) + blue + [neutral]
+
+def encode_move(searcher, move):
+    return move.start | move.end << 5 | oni.CARD_IDS[searcher.card_data[move.card].name] << 10
+
+# Apply a symmetry (see symmetry.py) to a move code. Its own inverse
+def transform_code(code, swap, mirror):
+    start, end, card_id = code & 31, code >> 5 & 31, code >> 10
+    if mirror:
+        card_id = oni.CARD_IDS[MIRROR_CARD[oni.ALL_CARDS[card_id].name()]]
+    return (transform_square(start, swap, mirror) | transform_square(end, swap, mirror) << 5
+            | card_id << 10)
+
+# Book key for the AI's position, and the symmetry taking it to the canonical one
+def position_key(searcher):
+    key, transform = canonical_position(searcher)
+    return canonical_hash(key), transform
+
+# The AI move matching a book move code, or None if it is not legal
+def decode_move(searcher, code):
+    start, end, card_id = code & 31, code >> 5 & 31, code >> 10
+    for move in searcher.next_moves():
+        if (move.start == start and move.end == end
+                and oni.CARD_IDS[searcher.card_data[move.card].name] == card_id):
+            return move
+    return None
+
+# Search every position within plies of the start of each game in card_sets
+# Returns a dict mapping hash -> (move code, depth, score)
+def build(card_sets, plies, depth, time_limit=None, log=None):
+    entries = dict()
+    searcher = ai.MoveUnmoveAI()
+    def visit(game, plies_left):
+        searcher.set_game_as_root(game)
+        key, transform = position_key(searcher)
+        if searcher.root.end or key in entries:
+            return
+        move = searcher.find_move(depth=depth, time_limit=time_limit)
+        if move is None:
+            return
+        entries[key] = (transform_code(encode_move(searcher, move), *transform),
+                        searcher.completed_depth, searcher.score)
+        if plies_left <= 1:
+            return
+        card_names, moves = game_spec(game)
+        for reply in searcher.next_moves():
+            game_move = searcher.create_game_move(reply)
+            child = game_from_spec((card_names, moves + ((game_move.start, game_move.end, game_move.card.name()),)))
+            visit(child, plies_left-1)
+            searcher.set_game_as_root(game)
+    for i, start_cards in enumerate(card_sets):
+        visit(oni.Game(start_cards), plies)
+        if log is not None:
+            log('{} card sets, {} positions'.format(i+1, len(entries)))
+    return entries
+
+def write(path, entries):
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(entries)))
+        for key in sorted(entries):
+            move, depth, score = entries[key]
+            f.write(ENTRY.pack(key, move, min(depth, 255), score))
+
+
+class BookError(Exception):
+    pass
+
+
+class Book:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise BookError('not a book file: {}'.format(path))
+        self.count, = struct.unpack_from('<I', self.map, len(MAGIC))
+        self.offset = len(MAGIC) + 4
+        if len(self.map) < self.offset + self.count * ENTRY.size:
+            self.close()
+            raise BookError('truncated book file: {}'.format(path))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self.map, self.offset + i * ENTRY.size)
+
+    # (move code, depth, score) for the position with the given hash, or None
+    def get(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.entry(middle)
+            if entry[0] < key:
+                low = middle + 1
+            elif entry[0] > key:
+                high = middle
+            else:
+                return entry[1:]
+        return None
+
+    # Book move for the AI's current position, as an AI move, and its entry
+    def lookup(self, searcher):
+        key, transform = position_key(searcher)
+        entry = self.get(key)
+        if entry is None:
+            return None, None
+        return decode_move(searcher, transform_code(entry[0], *transform)), entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build an Onitama opening book')
+    parser.add_argument('cards', nargs='*',
+                        help='five card names (red, red, blue, blue, neutral); default all card sets')
+    parser.add_argument('--plies', type=int, default=2, help='plies from the start to cover')
+    parser.add_argument('--depth', type=int, default=6, help='search depth per position')
+    parser.add_argument('--time-limit', type=float, help='seconds per position')
+    parser.add_argument('--sample', type=int, help='only build this many random card sets')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', required=True, help='output file')
+    args = parser.parse_args(argv)
+    if args.cards:
+        if len(args.cards) != 5:
+            parser.error('expected five card names')
+        card_sets = [[oni.NAME_TO_CARD[name.lower()] for name in args.cards]]
+    else:
+        card_sets = list(card_set_classes())
+        if args.sample:
+            card_sets = random.Random(args.seed).sample(card_sets, args.sample)
+    entries = build(card_sets, args.plies, args.depth, args.time_limit,
+                    log=lambda text: print(text, file=sys.stderr))
+    write(args.output, entries)
+    print('{} positions'.format(len(entries)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
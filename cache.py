@@ -0,0 +1,143 @@
+'''
+Persistent analysis cache: search results kept on disk between runs
+
+MoveUnmoveAI.find_move consults the cache (pass cache= to MoveUnmoveAI) before
+searching and writes its result back afterwards. A position already searched
+at least as deep as asked is answered from the cache; otherwise the cached
+move and score are put in the transposition table, so the search starts
+with the right move at the root.
+
+Positions are keyed as in the opening book (see book.py): by the Zobrist hash
+of their canonical form, so symmetric positions share an entry, with moves
+stored for the canonical position. Scores depend on the evaluator, so a cache
+file should only be shared by searches using the same one.
+
+File layout: MAGIC, a header (bits, clock) and WAYS << bits fixed-size slots
+(key, move, depth, stamp, score) in buckets of WAYS. The size is fixed when the
+file is created. A position can only go in the bucket picked by its key's low
+bits: a deeper result replaces a shallower one for the same position, and
+a new position takes an empty slot, or else the least recently used one of
+the bucket. stamp is the value of clock, counting lookups and stores, when the
+entry was last used. The file is memory-mapped and changed in place, so
+entries survive the process without an explicit save; it is not safe for
+several processes to write to one file at once.
+
+    python cache.py analysis.bin          number of entries and size
+'''
+import argparse
+import mmap
+import os
+import struct
+import sys
+from book import position_key, encode_move, transform_code, decode_move
+
+MAGIC = b'ONIAC\x00\x01\x00'
+HEADER = struct.Struct('<II')
+SLOT = struct.Struct('<QHBxId')
+WAYS = 4
+DEFAULT_BITS = 16
+
+
+class CacheError(Exception):
+    pass
+
+
+class AnalysisCache:
+    # Opens the cache at path, creating it with WAYS << bits slots if it
+    # does not exist. An existing file keeps the size it was created with
+    def __init__(self, path, bits=DEFAULT_BITS):
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(MAGIC + HEADER.pack(bits, 0))
+                f.truncate(len(MAGIC) + HEADER.size + SLOT.size * (WAYS << bits))
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CacheError('not an analysis cache file: {}'.format(path))
+        self.bits, self.clock = HEADER.unpack_from(self.map, len(MAGIC))
+        self.mask = (1 << self.bits) - 1
+        self.offset = len(MAGIC) + HEADER.size
+        if len(self.map) < self.offset + SLOT.size * (WAYS << self.bits):
+            self.close()
+            raise CacheError('truncated analysis cache file: {}'.format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Number of slots in use
+    def __len__(self):
+        return sum(1 for i in range(WAYS << self.bits) if self.slot(i)[2])
+
+    def close(self):
+        if not self.map.closed:
+            self.map.flush()
+            self.map.close()
+        self.file.close()
+
+    def slot(self, i):
+        return SLOT.unpack_from(self.map, self.offset + i * SLOT.size)
+
+    def tick(self):
+        self.clock = self.clock + 1 & 0xFFFFFFFF
+        HEADER.pack_into(self.map, len(MAGIC), self.bits, self.clock)
+        return self.clock
+
+    # (move code, depth, score) for the position with the given hash, or None
+    def get(self, key):
+        first = (key & self.mask) * WAYS
+        for i in range(first, first + WAYS):
+            slot_key, move, depth, _, score = self.slot(i)
+            if depth and slot_key == key:
+                SLOT.pack_into(self.map, self.offset + i * SLOT.size, key, move, depth, self.tick(), score)
+                return move, depth, score
+        return None
+
+    def put(self, key, move, depth, score):
+        first = (key & self.mask) * WAYS
+        ranks = []
+        for i in range(first, first + WAYS):
+            slot_key, _, slot_depth, stamp, _ = self.slot(i)
+            if slot_depth and slot_key == key:
+                if depth < slot_depth:
+                    return
+                ranks = [((), i)]
+                break
+            # Empty slots first, then the least recently used
+            ranks.append(((slot_depth > 0, -(self.clock - stamp & 0xFFFFFFFF)), i))
+        victim = min(ranks)[1]
+        SLOT.pack_into(self.map, self.offset + victim * SLOT.size,
+                       key, move, min(depth, 255), self.tick(), score)
+
+    # Cached move for the AI's current position, as an AI move, and its entry
+    # (move code, depth, score). The move is None if the position is not cached
+    def lookup(self, searcher):
+        key, transform = position_key(searcher)
+        entry = self.get(key)
+        if entry is None:
+            return None, None
+        return decode_move(searcher, transform_code(entry[0], *transform)), entry
+
+    # Record the result of a search of the AI's current position
+    def store(self, searcher, move, depth, score):
+        key, transform = position_key(searcher)
+        self.put(key, transform_code(encode_move(searcher, move), *transform), depth, score)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the size and use of an analysis cache')
+    parser.add_argument('path', help='cache file')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.path):
+        parser.error('no such file: {}'.format(args.path))
+    with AnalysisCache(args.path) as cache:
+        slots = WAYS << cache.bits
+        print('{} of {} slots used ({} bytes), clock {}'.format(
+            len(cache), slots, cache.offset + slots * SLOT.size, cache.clock))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
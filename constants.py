@@ -12,3 +12,12 @@ BLUEKING = -2
 # Goal square for kings (Reach goal and win game)
 REDGOAL = 22
 BLUEGOAL = 2
+
+# Squares for each bit set in a 25-bit mask (bit i for square i), filled in lazily
+class SquareTable(dict):
+    def __missing__(self, mask):
+        squares = tuple(i for i in range(25) if mask >> i & 1)
+        self[mask] = squares
+        return squares
+
+SQUARES = SquareTable()
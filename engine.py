@@ -0,0 +1,239 @@
+'''
+Long-running engine speaking a line protocol, in the spirit of UCI
+
+One MoveUnmoveAI is kept for the life of the process, so its transposition
+table, history scores and card tables stay warm from one request to the next.
+Commands, one per line:
+
+    onitama                       -> id lines, then onitamaok
+    isready                       -> readyok
+    newgame                       forget everything learnt so far
+    position cards <5 names> [moves <moves>]
+                                  cards in start_cards order, moves in
+                                  Move.parse_moves notation, e.g.
+                                  position cards tiger monkey crab boar mantis moves c1-c3 [tiger]
+    go [depth <n>] [movetime <ms>] [infinite]
+                                  search the position in the background
+                                  default: depth DEFAULT_DEPTH
+    stop                          end the search, which then reports its best move
+    quit
+
+While searching, the engine prints one line per completed depth:
+
+    info depth 5 score 0.12 nodes 4242 time 80 nps 53025 pv c1-c3 [tiger] b5-b4 [crab]
+
+followed by "bestmove c1-c3 [tiger]" (or "bestmove none" when the game is over).
+Scores are from the side to move's point of view, "mate" or "-mate" for a forced
+result. Problems are reported as "info string error: ..." lines.
+
+    python engine.py                      stdin/stdout
+    python engine.py --socket 7420        one client at a time on localhost:7420
+    python engine.py --cache analysis.bin keep search results between runs, see cache.py
+'''
+import argparse
+import socket
+import sys
+import threading
+import onitama as oni
+import ai
+from cache import AnalysisCache
+
+DEFAULT_DEPTH = 6
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# The game for a position command's arguments
+def parse_position(words):
+    if len(words) < 6 or words[0] != 'cards':
+        raise ProtocolError('expected: position cards <5 names> [moves <moves>]')
+    try:
+        start_cards = [oni.NAME_TO_CARD[name.lower()] for name in words[1:6]]
+    except KeyError as e:
+        raise ProtocolError('unknown card: {}'.format(e.args[0]))
+    game = oni.Game(start_cards)
+    if len(words) > 6:
+        if words[6] != 'moves':
+            raise ProtocolError('expected moves after the cards')
+        if len(words) > 7:
+            try:
+                for move in oni.Move.parse_moves(game.active_player, ' '.join(words[7:])):
+                    game.do_move(move)
+            except oni.MoveParseError:
+                raise ProtocolError('bad move list')
+            except oni.IllegalMoveError:
+                raise ProtocolError('illegal move: {}'.format(move.notation()))
+    return game
+
+# find_move keyword arguments for a go command's arguments
+def parse_go(words):
+    options = dict()
+    words = list(words)
+    try:
+        while words:
+            word = words.pop(0)
+            if word == 'depth':
+                options['max_depth'] = int(words.pop(0))
+            elif word == 'movetime':
+                options['time_limit'] = int(words.pop(0)) / 1000
+            elif word == 'infinite':
+                options['max_depth'] = ai.DEFAULT_MAX_DEPTH
+            else:
+                raise ProtocolError('unknown go option: {}'.format(word))
+    except (IndexError, ValueError):
+        raise ProtocolError('expected: go [depth <n>] [movetime <ms>] [infinite]')
+    if 'max_depth' not in options and 'time_limit' not in options:
+        options['max_depth'] = DEFAULT_DEPTH
+    return options
+
+def format_score(score):
+    if score == float('inf'):
+        return 'mate'
+    if score == -float('inf'):
+        return '-mate'
+    return '{:.4f}'.format(score)
+
+def info_line(searcher):
+    stats = searcher.stats
+    pv = ' '.join(searcher.create_game_move(move).notation() for move in searcher.principal_variation)
+    return 'info depth {} score {} nodes {} time {} nps {:.0f} pv {}'.format(
+        searcher.completed_depth, format_score(searcher.score), stats.nodes,
+        int(stats.seconds * 1000), stats.nodes_per_second, pv)
+
+
+class Engine:
+    def __init__(self, output, **options):
+        # output: called with each line to send, without the newline
+        self.output = output
+        self.options = options
+        self.ai = ai.MoveUnmoveAI(**options)
+        self.game = None
+        self.thread = None
+        self.stop_event = None
+        self.lock = threading.Lock()
+
+    def send(self, line):
+        with self.lock:
+            self.output(line)
+
+    # Handle one command line. Returns False after quit
+    def handle(self, line):
+        words = line.split()
+        if not words:
+            return True
+        command, args = words[0], words[1:]
+        try:
+            if command == 'quit':
+                self.stop()
+                return False
+            elif command == 'onitama':
+                self.send('id name onitama')
+                self.send('onitamaok')
+            elif command == 'isready':
+                self.send('readyok')
+            elif command == 'newgame':
+                self.stop()
+                self.ai = ai.MoveUnmoveAI(**self.options)
+            elif command == 'position':
+                self.stop()
+                # A bad position leaves none, rather than the one before it
+                self.game = None
+                self.game = parse_position(args)
+            elif command == 'go':
+                self.go(parse_go(args))
+            elif command == 'stop':
+                self.stop()
+            else:
+                raise ProtocolError('unknown command: {}'.format(command))
+        except ProtocolError as e:
+            self.send('info string error: {}'.format(e))
+        return True
+
+    def go(self, options):
+        if self.game is None:
+            raise ProtocolError('no position')
+        self.stop()
+        self.stop_event = threading.Event()
+        self.ai.set_game_as_root(self.game)
+        self.thread = threading.Thread(target=self.search, args=(options, self.stop_event), daemon=True)
+        self.thread.start()
+
+    # Runs in the search thread
+    def search(self, options, stop):
+        move = self.ai.find_move(stop=stop, progress=lambda searcher: self.send(info_line(searcher)), **options)
+        if move is None:
+            self.send('bestmove none')
+        else:
+            self.send('bestmove ' + self.ai.create_game_move(move).notation())
+
+    # End the running search, if any, once it has reported its best move
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    # Read commands from a file object until quit or end of input
+    def run(self, lines):
+        for line in lines:
+            if not self.handle(line):
+                return False
+        self.stop()
+        return True
+
+
+def serve_stdio(options):
+    def output(line):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+    Engine(output, **options).run(sys.stdin)
+
+# Serve clients on a local socket, one at a time. The engine, and with it the
+# warm caches, is shared by all of them
+def serve_socket(port, options, host='127.0.0.1'):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    engine = Engine(None, **options)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('r') as reader, connection.makefile('w') as writer:
+                def output(line):
+                    try:
+                        writer.write(line + '\n')
+                        writer.flush()
+                    except OSError:
+                        pass
+                engine.output = output
+                if not engine.run(reader):
+                    break
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Onitama engine speaking a line protocol')
+    parser.add_argument('--socket', type=int, metavar='PORT', help='listen on localhost:PORT instead of stdin')
+    parser.add_argument('--tt-bits', type=int, default=20, help='transposition table size, log 2')
+    parser.add_argument('--algorithm', choices=ai.ALGORITHMS, default='alphabeta')
+    parser.add_argument('--cache', metavar='FILE', help='persistent analysis cache, created if missing')
+    args = parser.parse_args(argv)
+    options = {'tt_bits': args.tt_bits, 'algorithm': args.algorithm}
+    if args.cache is not None:
+        options['cache'] = AnalysisCache(args.cache)
+    try:
+        if args.socket is not None:
+            serve_socket(args.socket, options)
+        else:
+            serve_stdio(options)
+    finally:
+        if args.cache is not None:
+            options['cache'].close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,64 +4,77 @@ Evaulation functions to be used by the AI go in here
 Functions should all be antisymmetric with respect to player
 That is, eval(RED) == -eval(BLUE)
 '''
+try:
+    import numpy as np
+except ImportError:
+    np = None
+import onitama as oni
 from constants import *
 
-def get_evaluator(ai):
+def get_evaluator(ai, incremental=False):
     return Evaluator(
         board=ai.board,
-        pieces=ai.pieces,
+        bitboards=ai.bitboards,
+        kings=ai.kings,
         cards=ai.cards,
         card_data=ai.card_data,
+        mobility_counts=ai.mobility if incremental else None,
     )
 
 '''
-An evaluator that makes use of piece location sets to improve performance
-The AI must be maintaining location sets to use this evaluator
-A location set is a set of piece locations (indices into board) for a given type of piece
+An evaluator that reads the pieces from the AI's bitboards and king squares
+The AI must keep these up to date as it moves (see MoveUnmoveAI):
+bitboards[player] has bit i set if player has a piece on square i, and
+kings[player] is the square of player's king, None once it is captured
+
+Incremental mode: if mobility_counts is given, mobility is read from it instead
+of being recomputed. mobility_counts[player][card] must hold the number of moves
+that card (an index into card_data) gives player, kept up to date by the AI
+(MoveUnmoveAI does this in do_move/undo_move)
 '''
 class Evaluator:
-    def __init__(self, board, pieces, cards, card_data,
-                pawn_weight=1, mobility_weight=0.01, true_mobility_factor=1.25):
+    def __init__(self, board, bitboards, kings, cards, card_data,
+                pawn_weight=1, mobility_weight=0.01, true_mobility_factor=1.25,
+                mobility_counts=None):
         self.board = board
-        self.pieces = pieces
+        self.bitboards = bitboards
+        self.kings = kings
         self.cards = cards
         self.card_data = card_data
         self.pawn_weight = pawn_weight
         self.mobility_weight = mobility_weight
         self.true_mobility_factor = true_mobility_factor
+        self.mobility_counts = mobility_counts
 
     # Evaluate in subroutines always from RED's perspective
     # Negate the final result if BLUE's evaluation was needed
+    # Both kings are on the board (see victory), so the pawns make the difference
     def pawns(self):
-        return len(self.pieces[REDPAWN]) - len(self.pieces[BLUEPAWN])
+        return self.bitboards[RED].bit_count() - self.bitboards[BLUE].bit_count()
 
     def victory(self):
-        if len(self.pieces[BLUEKING]) == 0 or REDGOAL in self.pieces[REDKING]:
+        red_king, blue_king = self.kings
+        if blue_king is None or red_king == REDGOAL:
             return float('inf')
-        elif len(self.pieces[REDKING]) == 0 or BLUEGOAL in self.pieces[BLUEKING]:
+        elif red_king is None or blue_king == BLUEGOAL:
             return -float('inf')
         else:
             return 0
 
     def mobility(self):
+        if self.mobility_counts is not None:
+            return self.cached_mobility()
         red_scores = [0]*5
         blue_scores = [0]*5
         # count number of moves that each card offers
+        red_pieces, blue_pieces = self.bitboards
         for index, card in enumerate(self.card_data):
-            red_pieces = self.pieces[REDPAWN] | self.pieces[REDKING]
-            red_score = 0
-            for move_source in red_pieces:
-                for move_target in card.moves[RED][move_source]:
-                    if move_target not in red_pieces:
-                        red_score += 1 # score 1 for each legal move
-            red_scores[index] = red_score
-            blue_pieces = self.pieces[BLUEPAWN] | self.pieces[BLUEKING]
-            blue_score = 0
-            for move_source in blue_pieces:
-                for move_target in card.moves[BLUE][move_source]:
-                    if move_target not in blue_pieces:
-                        blue_score += 1
-            blue_scores[index] = blue_score
+            # score 1 for each legal move
+            red_masks, blue_masks = card.masks
+            red_scores[index] = sum((red_masks[square] & ~red_pieces).bit_count()
+                                    for square in SQUARES[red_pieces])
+            blue_scores[index] = sum((blue_masks[square] & ~blue_pieces).bit_count()
+                                     for square in SQUARES[blue_pieces])
         # Each card gives a mobility score, but a player only holds two cards
         # Consider "true mobility" to be the mobility induced by the player's cards
         # Compute mobility over all cards, but scale true mobility by a factor
@@ -75,6 +88,27 @@ class Evaluator:
             blue_mobility += factor*blue_scores[i] if i in blue_cards else blue_scores[i]
         return red_mobility - blue_mobility
 
+    # Same result as mobility(), as a weighted sum of the cached counts
+    def cached_mobility(self):
+        red_scores, blue_scores = self.mobility_counts
+        extra = self.true_mobility_factor - 1
+        cards = self.cards
+        return (sum(red_scores) - sum(blue_scores)
+                + extra*(red_scores[cards[0]] + red_scores[cards[1]]
+                         - blue_scores[cards[2]] - blue_scores[cards[3]]))
+
+    # Bound on how much a single move that captures nothing (and does not win)
+    # can change the evaluation, for futility pruning.
+    # Material is unchanged, and so are the opponent's move counts, which depend
+    # only on the opponent's pieces. For each of the 5 cards, the mover's count
+    # changes by at most 16: the moving piece loses and gains up to 4 moves, and
+    # up to 4 other pieces can reach each of the two squares involved.
+    # Handing over a card moves the true mobility factor from one card's count
+    # (at most 20: 5 pieces, 4 moves each) to another's
+    def futility_margin(self):
+        factor = self.true_mobility_factor
+        return self.mobility_weight * (16*5*factor + 20*abs(factor-1))
+
     def evaluate(self, player):
         if player != RED and player != BLUE:
             raise EvaluatorError('player must be RED or BLUE')
@@ -84,5 +118,70 @@ class Evaluator:
         return result if player == RED else -result
 
 
+'''
+Batched evaluation with numpy (optional, only needed for BatchEvaluator)
+
+Scores many positions at once, with the same result as Evaluator.evaluate.
+Positions are given as an (N, 25) int8 array of boards, in the AI's board
+representation (see constants.py), an (N, 5) array of card indices into
+onitama.ALL_CARDS in the AI's card order (red, red, blue, blue, neutral),
+and the player to score for, one for all positions or an (N,) array.
+Move counts come from a table of card target masks, one matrix product per player
+for all positions and cards.
+'''
+
+# A row of the BatchEvaluator arrays for the AI's current position:
+# (board, card indices, player to move)
+def batch_row(ai):
+    cards = [oni.CARD_IDS[ai.card_data[card].name] for card in ai.cards]
+    return list(ai.board), cards, ai.active_player
+
+class BatchEvaluator:
+    def __init__(self, pawn_weight=1, mobility_weight=0.01, true_mobility_factor=1.25):
+        if np is None:
+            raise EvaluatorError('BatchEvaluator requires numpy')
+        self.pawn_weight = pawn_weight
+        self.mobility_weight = mobility_weight
+        self.true_mobility_factor = true_mobility_factor
+        # targets[player][start, card*25 + end] is 1 if card moves player's
+        # piece from start to end
+        count = len(oni.ALL_CARDS)
+        self.targets = np.zeros((2, 25, count*25), dtype=np.float32)
+        for index, card in enumerate(oni.ALL_CARDS):
+            for player in oni.Player:
+                for (x, y), ends in card.targets[player].items():
+                    for u, v in ends:
+                        self.targets[player.value, x + 5*y, index*25 + u + 5*v] = 1
+
+    # (N, len(ALL_CARDS), 2) array: the number of moves each card gives each player
+    def move_counts(self, boards):
+        count = len(oni.ALL_CARDS)
+        counts = np.empty((len(boards), count, 2), dtype=np.float32)
+        for player, pieces in [(RED, boards > 0), (BLUE, boards < 0)]:
+            pieces = pieces.astype(np.float32)
+            # For each card and end square, how many of the player's pieces reach it
+            reach = (pieces @ self.targets[player]).reshape(len(boards), count, 25)
+            counts[:, :, player] = np.einsum('nct,nt->nc', reach, 1 - pieces)
+        return counts
+
+    def mobility(self, boards, cards):
+        counts = np.take_along_axis(self.move_counts(boards), cards[:, :, None], axis=1)
+        red, blue = counts[:, :, RED].astype(np.float64), counts[:, :, BLUE].astype(np.float64)
+        extra = self.true_mobility_factor - 1
+        return (red.sum(axis=1) - blue.sum(axis=1)
+                + extra*(red[:, 0] + red[:, 1] - blue[:, 2] - blue[:, 3]))
+
+    def evaluate(self, boards, cards, player=RED):
+        boards = np.asarray(boards, dtype=np.int8).reshape(-1, 25)
+        cards = np.asarray(cards, dtype=np.intp).reshape(-1, 5)
+        pawns = (boards == REDPAWN).sum(axis=1) - (boards == BLUEPAWN).sum(axis=1)
+        result = self.pawn_weight*pawns + self.mobility_weight*self.mobility(boards, cards)
+        red_wins = ~(boards == BLUEKING).any(axis=1) | (boards[:, REDGOAL] == REDKING)
+        blue_wins = ~red_wins & (~(boards == REDKING).any(axis=1) | (boards[:, BLUEGOAL] == BLUEKING))
+        result[red_wins] = float('inf')
+        result[blue_wins] = -float('inf')
+        return np.where(np.asarray(player) == RED, result, -result)
+
+
 class EvaluatorError(Exception):
     pass
@@ -3,7 +3,10 @@ from math import floor
 import onitama as oni
 from ai import create_ai
 from collections import defaultdict
+import queue
 import random
+import threading
+import time
 
 class GUI:
     rows = 5
@@ -86,8 +89,28 @@ class GUI:
         self.selected = None
         self.target = None
         self.ai = create_ai()
-        self.ai_depth = 4
+        self.ai_time_limit = 2.0
+        self.ai_max_depth = 10
         self.ai_wait = 20
+        # The AI searches in a background thread, see start_search
+        # Its progress and result come back through search_queue, tagged with
+        # the search number so that results of cancelled searches are dropped
+        self.search_queue = queue.Queue()
+        self.search_thread = None
+        self.search_stop = None
+        self.search_number = 0
+        self.search_kind = None
+        self.search_timer = None
+        self.poll_interval = 50
+        # Pondering, see start_ponder. ponder_mode is 'predicted' (search the
+        # position after the predicted reply) or 'all' (search the user's position)
+        self.ponder = BooleanVar(value=True)
+        self.ponder_mode = 'predicted'
+        self.prediction = None
+        self.ponder_move = None
+        self.ponder_result = None
+        self.ponder_prediction = None
+        self.menubar.add_checkbutton(label="Ponder", variable=self.ponder, command=self.toggle_ponder)
         self.new_game()
 
     def new_game(self):
@@ -96,6 +119,8 @@ class GUI:
         self.set_game(game=game, user=oni.Player.RED)
 
     def set_game(self, game, user):
+        self.cancel_search()
+        self.prediction = None
         if self.game is not None:
             self.game.remove_listener(self)
         self.game = game
@@ -104,6 +129,7 @@ class GUI:
         self.card_names = [card.name() for card in game.start_cards]
         self.undo_highlights('all')
         self.update_game_state()
+        self.update_analysis('')
         if not self.game.active_player is self.user:
             self.parent.after(self.ai_wait, self.do_ai_move)
 
@@ -112,9 +138,14 @@ class GUI:
             self.update_game_state()
 
     def flip_board(self):
+        searching = self.cancel_search()
         self.flip = not self.flip
         self.draw_board()
         self.update_game_state()
+        if searching == 'search':
+            self.start_search()
+        elif searching == 'ponder':
+            self.start_ponder()
 
     def update_game_state(self):
         self.draw_pieces(self.game.board.array)
@@ -322,11 +353,6 @@ class GUI:
 
     def highlight_targets(self):
         if self.selected is not None:
-            legal_targets = [
-                target
-                for moves in self.game.legal_moves().values()
-                for target in moves.get(self.selected)
-            ]
             for target in self.game.legal_move_targets(self.selected):
                 self.highlight_square(target, 'candidate')
 
@@ -397,13 +423,145 @@ class GUI:
             self.parent.after(self.ai_wait, self.do_ai_move)
 
     def do_ai_move(self):
-        self.ai.set_game_as_root(self.game)
-        move = self.ai.find_move(self.ai_depth)
-        card_name = self.ai.card_data[move.card].name
-        card = oni.NAME_TO_CARD[card_name]
-        start = move.start % 5, move.start // 5
-        end = move.end % 5, move.end // 5
-        self.do_game_move(start, end, card)
+        if self.game.active_player is self.user or self.game.check_victory() is not None:
+            return
+        if self.search_kind == 'ponder' and self.ponder_move is not None and same_move(
+                self.ponder_move, self.game.moves[-1]):
+            self.ponder_hit()
+        else:
+            self.start_search()
+
+    # Search the current position in a background thread, so that the window
+    # stays responsive. poll_search picks up the result
+    def start_search(self):
+        self.run_in_background('search', self.game, self.ai_time_limit)
+
+    # Pondering: while the user thinks, search the position after the reply
+    # the last search predicted, or if there is none the user's position itself.
+    # Either way the transposition table keeps what was found for the real search,
+    # and if the prediction was right the ponder search carries on as the real one
+    def start_ponder(self):
+        game = self.game
+        self.ponder_move = None
+        if self.ponder_mode == 'predicted' and self.prediction is not None:
+            game = self.game.clone()
+            game.do_move(self.prediction)
+            self.ponder_move = self.prediction
+        self.ponder_result = None
+        self.ponder_start = time.monotonic()
+        self.run_in_background('ponder', game, None)
+
+    # The user played the predicted move: the ponder search becomes the real
+    # one. Time spent pondering counts towards ai_time_limit, so the AI answers
+    # at once if the user took longer than that
+    def ponder_hit(self):
+        self.search_kind = 'search'
+        if self.search_thread is None:
+            # Already finished, at ai_max_depth or with a forced result
+            self.search_kind = None
+            if self.ponder_result is not None:
+                self.play_ai_move(self.ponder_result, self.ponder_prediction)
+            else:
+                self.start_search()
+            return
+        remaining = self.ai_time_limit - (time.monotonic() - self.ponder_start)
+        self.search_timer = threading.Timer(max(remaining, 0), self.search_stop.set)
+        self.search_timer.daemon = True
+        self.search_timer.start()
+
+    def run_in_background(self, kind, game, time_limit):
+        self.cancel_search()
+        self.search_kind = kind
+        self.search_number += 1
+        self.search_stop = threading.Event()
+        self.ai.set_game_as_root(game)
+        self.search_thread = threading.Thread(
+            target=self.run_search,
+            args=(self.ai, self.search_number, self.search_stop, time_limit),
+            daemon=True,
+        )
+        self.search_thread.start()
+        self.parent.after(self.poll_interval, self.poll_search, self.search_number)
+
+    # Runs in the search thread. Only touches the AI and the queue
+    # The result is the move found and the reply predicted for it
+    def run_search(self, searcher, number, stop, time_limit):
+        def progress(searcher):
+            self.search_queue.put((number, 'info', analysis_text(searcher)))
+        move = searcher.find_move(
+            time_limit=time_limit,
+            max_depth=self.ai_max_depth,
+            stop=stop,
+            progress=progress,
+        )
+        game_move, prediction = None, None
+        if move is not None:
+            game_move = searcher.create_game_move(move)
+            if len(searcher.principal_variation) > 1:
+                prediction = searcher.create_game_move(searcher.principal_variation[1])
+        self.search_queue.put((number, 'done', (game_move, prediction)))
+
+    # Stop the running search or ponder search, if any, and wait for its
+    # thread to notice, which takes at most 1024 nodes.
+    # Returns what was running: 'search', 'ponder' or None
+    def cancel_search(self):
+        kind = self.search_kind
+        self.search_kind = None
+        if self.search_timer is not None:
+            self.search_timer.cancel()
+            self.search_timer = None
+        if self.search_thread is not None:
+            self.search_stop.set()
+            self.search_thread.join()
+            self.search_thread = None
+        self.search_number += 1
+        return kind
+
+    # Handle messages from the search thread until search number is done or cancelled
+    def poll_search(self, number):
+        if number != self.search_number:
+            return
+        while True:
+            try:
+                message_number, kind, value = self.search_queue.get_nowait()
+            except queue.Empty:
+                break
+            if message_number != number:
+                continue
+            if kind == 'info':
+                prefix = 'Pondering\n' if self.search_kind == 'ponder' else ''
+                self.update_analysis(prefix + value)
+            elif kind == 'done':
+                self.search_thread = None
+                if self.search_kind == 'ponder':
+                    # Kept in case the prediction turns out right
+                    self.ponder_result, self.ponder_prediction = value
+                    return
+                self.search_kind = None
+                self.play_ai_move(*value)
+                return
+        self.parent.after(self.poll_interval, self.poll_search, number)
+
+    def play_ai_move(self, move, prediction):
+        if move is None:
+            return
+        self.prediction = prediction
+        self.do_game_move(move.start, move.end, move.card)
+        if (self.ponder.get() and self.game.active_player is self.user
+                and self.game.check_victory() is None):
+            self.start_ponder()
+
+    def toggle_ponder(self):
+        if not self.ponder.get():
+            if self.search_kind == 'ponder':
+                self.cancel_search()
+        elif self.game.active_player is self.user and self.game.check_victory() is None:
+            self.prediction = None
+            self.start_ponder()
+
+# Same start, end and card
+def same_move(a, b):
+    return (a.start, a.end, a.card) == (b.start, b.end, b.card)
 
 # Assign 'markings' to a board coordinate
 # For managing highlighting and various interface decorations
@@ -484,6 +642,14 @@ class HighlightManager(MarkingManager):
             return self.color[type]
 
 
+# Search progress: depth, score and time, the search statistics (see
+# ai.SearchStats), then the principal variation
+def analysis_text(searcher):
+    stats = searcher.stats
+    pv = ' '.join(searcher.create_game_move(move).notation() for move in searcher.principal_variation)
+    return 'depth {}  score {:+.2f}  time {:.2f}s\n{}\n{}'.format(
+        searcher.completed_depth, searcher.score, stats.seconds, stats, pv)
+
 def parse_str_coord(coord):
     # String format: 'x,y'
     try:
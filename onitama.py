@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from enum import Enum
 import re
 
@@ -37,13 +37,21 @@ class Board:
 
     @staticmethod
     def in_bounds(loc):
-        return loc[0] in range(5) and loc[1] in range(5)
+        return 0 <= loc[0] < 5 and 0 <= loc[1] < 5
 
 
 class BoardBoundsError(Exception):
     pass
 
 
+# Everything needed to put a Game back in a position, see Game.snapshot
+# board: tuple of the 25 Pieces in Board.array order
+# red_cards, blue_cards: tuples in the order of Game.cards
+# moves: tuple of the Moves played to reach the position
+# undo: what undo_move needs to take each of them back
+GameState = namedtuple('GameState', 'board red_cards blue_cards neutral_card active_player moves undo')
+
+
 class Game:
 
     def __init__(self, start_cards):
@@ -67,6 +75,12 @@ class Game:
             Player.BLUE: {(2, 4)}
         }
         self.listeners = []
+        # (captured piece, index of the card played in its owner's hand)
+        # for each move in self.moves, see undo_move
+        self._undo = []
+        # legal_moves() for the position in _legal_moves_key, see legal_moves
+        self._legal_moves = None
+        self._legal_moves_key = None
 
     def add_listener(self, listener):
         self.listeners.append(listener)
@@ -104,15 +118,79 @@ class Game:
                 self.pawns[opp].remove(move.end)
             self.board.set(move.start, Piece.EMPTY)
             self.board.set(move.end, piece)
+            self._undo.append((dest_piece, self.cards[move.player].index(move.card)))
             self.cards[move.player].append(self.neutral_card)
             self.cards[move.player].remove(move.card)
             self.neutral_card = move.card
             self.moves.append(move)
             self.active_player = opp
+            self._legal_moves = None
             self.notify_move(move, self)
         else:
             raise IllegalMoveError
 
+    # Take back the last move played. Listeners are not notified
+    # Returns the move, or raises IllegalMoveError if no move has been played
+    def undo_move(self):
+        if not self.moves:
+            raise IllegalMoveError
+        move = self.moves.pop()
+        captured, card_index = self._undo.pop()
+        piece = self.board.get(move.end)
+        pieces = self.kings if piece.is_king() else self.pawns
+        pieces[move.player].remove(move.end)
+        pieces[move.player].add(move.start)
+        if captured.is_king():
+            self.kings[move.player.other()].add(move.end)
+        elif captured.is_pawn():
+            self.pawns[move.player.other()].add(move.end)
+        self.board.set(move.start, piece)
+        self.board.set(move.end, captured)
+        # The card received for move.card was appended last
+        self.neutral_card = self.cards[move.player].pop()
+        self.cards[move.player].insert(card_index, move.card)
+        self.active_player = move.player
+        self._legal_moves = None
+        return move
+
+    # Immutable copy of the position and the moves leading to it
+    def snapshot(self):
+        return GameState(
+            tuple(self.board.array),
+            tuple(self.cards[Player.RED]),
+            tuple(self.cards[Player.BLUE]),
+            self.neutral_card,
+            self.active_player,
+            tuple(self.moves),
+            tuple(self._undo),
+        )
+
+    # Return to a position taken by snapshot() on a game with the same start_cards
+    # Listeners are not notified
+    def restore(self, state):
+        self.board.array = list(state.board)
+        self.cards = {
+            Player.RED: list(state.red_cards),
+            Player.BLUE: list(state.blue_cards),
+        }
+        self.neutral_card = state.neutral_card
+        self.active_player = state.active_player
+        self.moves = list(state.moves)
+        self._undo = list(state.undo)
+        self.pawns = {Player.RED: set(), Player.BLUE: set()}
+        self.kings = {Player.RED: set(), Player.BLUE: set()}
+        for i, piece in enumerate(state.board):
+            if piece.is_king() or piece.is_pawn():
+                pieces = self.kings if piece.is_king() else self.pawns
+                pieces[Player.RED if piece.belongs_to(Player.RED) else Player.BLUE].add((i % 5, i // 5))
+        self._legal_moves = None
+
+    # A new Game in the same position, without listeners
+    def clone(self):
+        game = Game(self.start_cards)
+        game.restore(self.snapshot())
+        return game
+
     def check_victory(self):
         if not self.kings[Player.RED]:
             return Player.BLUE
@@ -129,22 +207,41 @@ class Game:
     # each start coordinate to a set of legal end coordinates.
     # Example: legal_moves()[card][(x, y)] is a set of legal end coordinates
     # for a move using Card card and starting at coordinate (x, y)
+    # The result is cached until the position changes and shared between
+    # callers, so it must not be modified.
     def legal_moves(self):
+        key = self.position_key()
+        if self._legal_moves is None or self._legal_moves_key != key:
+            self._legal_moves = self.compute_legal_moves()
+            self._legal_moves_key = key
+        return self._legal_moves
+
+    # Everything legal_moves depends on. The board is also changed directly,
+    # not only through do_move (e.g. to set up positions), so the cache is
+    # checked against this as well as being cleared by do_move
+    def position_key(self):
+        player = self.active_player
+        return (
+            player,
+            tuple(self.cards[player]),
+            frozenset(self.pawns[player]),
+            frozenset(self.kings[Player.RED]),
+            frozenset(self.kings[Player.BLUE]),
+        )
+
+    def compute_legal_moves(self):
         cards = self.cards[self.active_player]
         result = dict()
         for card in cards:
             result[card] = defaultdict(set)
         if self.check_victory() is not None:
             return result
-        board_range = {(x, y) for x in range(5) for y in range(5)}
         pieces = self.pawns[self.active_player].union(self.kings[self.active_player])
-        for coord in pieces:
-            for card in cards:
-                moves = card.moves[self.active_player]
-                end_coords = {
-                    (coord[0]+move[0], coord[1]+move[1]) for move in moves
-                }.intersection(board_range).difference(pieces)
-                result[card][coord] = result[card][coord].union(end_coords)
+        for card in cards:
+            targets = card.targets[self.active_player]
+            moves = result[card]
+            for coord in pieces:
+                moves[coord] = {end for end in targets[coord] if end not in pieces}
         return result
 
     def legal_move_sources(self):
@@ -159,7 +256,7 @@ class Game:
         return [
             target
             for moves in self.legal_moves().values()
-            for target in moves.get(start)
+            for target in moves.get(start, ())
         ]
 
     def get_card_choices_for_move(self, start, end):
@@ -196,6 +293,18 @@ class Move:
         # Checks that the move corresponds to a legal displacement vector
         return self.displacement() in self.card.moves[self.player]
 
+    # The move in parse_moves notation, e.g. 'c5-c4 [ox]'
+    def notation(self):
+        x_codes = 'abcdf'
+        return '{}{}-{}{} [{}]'.format(
+            x_codes[self.start[0]], self.start[1]+1,
+            x_codes[self.end[0]], self.end[1]+1, self.card.name())
+
+    # Inverse of parse_moves
+    @staticmethod
+    def format_moves(moves):
+        return ' '.join(move.notation() for move in moves)
+
     @staticmethod
     def parse_moves(start_player, move_string):
         try:
@@ -271,6 +380,15 @@ class Card:
             Player.BLUE: set([(-1*x, -1*y) for (x, y) in coordinates])
         }
         self.start_player = start_player
+        # targets[player][(x, y)] is the tuple of on-board end coordinates
+        # of this card's moves from (x, y)
+        self.targets = {
+            player: {
+                (x, y): tuple((x+i, y+j) for (i, j) in moves if 0 <= x+i < 5 and 0 <= y+j < 5)
+                for x in range(5) for y in range(5)
+            }
+            for player, moves in self.moves.items()
+        }
 
     def compute_moves(self, start_coord, player):
         x = start_coord[0]
@@ -318,3 +436,6 @@ NAME_TO_CARD = {
     'rabbit': RABBIT,
 }
 CARD_TO_NAME = { value: key for key, value in NAME_TO_CARD.items() }
+# Each card's index in ALL_CARDS, by name. Game records, opening books and
+# analysis caches store cards this way, so ALL_CARDS must keep its order
+CARD_IDS = {card.name(): i for i, card in enumerate(ALL_CARDS)}
@@ -0,0 +1,169 @@
+'''
+Parallel root search for MoveUnmoveAI using a process pool
+
+Young Brothers Wait: at each depth of iterative deepening, the first root move
+(the previous iteration's best, then captures, as ordered by move_selector) is
+searched serially with a full window. That gives a good lower bound, and the
+remaining root moves are then handed out to the workers, each searched with
+the best score known at the time it is submitted. Workers send back exact
+scores for moves that beat that bound, so the final score is the same as a
+serial alpha-beta search of the same depth.
+
+Games are sent to the workers as card names plus the list of moves played
+(see game_spec), since onitama.Card objects are compared by identity.
+Each worker process keeps one MoveUnmoveAI for its whole lifetime. By default
+they all search with one transposition.SharedTranspositionTable, shared with
+the main process too, so a position scored by one worker is not searched again
+by the others or at the next depth. With shared_tt=False each process has a
+table of its own.
+'''
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import os
+import onitama as oni
+import ai
+from transposition import SharedTranspositionTable
+
+# A picklable description of a game: start card names and moves played so far
+def game_spec(game):
+    return (
+        tuple(card.name() for card in game.start_cards),
+        tuple((move.start, move.end, move.card.name()) for move in game.moves),
+    )
+
+def game_from_spec(spec):
+    card_names, moves = spec
+    game = oni.Game([oni.NAME_TO_CARD[name] for name in card_names])
+    for start, end, card_name in moves:
+        game.do_move(oni.Move(game.active_player, start, end, oni.NAME_TO_CARD[card_name]))
+    return game
+
+_worker_ai = None
+_worker_shared = False
+_worker_search = None
+
+# Runs in each worker as it starts. table is the shared table, or None for
+# a table of tt_bits of its own
+def init_worker(table, tt_bits):
+    global _worker_ai, _worker_shared
+    _worker_ai = ai.MoveUnmoveAI(tt_bits=tt_bits, tt=table)
+    _worker_shared = table is not None
+
+# Runs in a worker: score the root move with the given code, searching
+# depth-1 plies below it with alpha as the bound to beat.
+# search numbers the calls of ParallelAI.find_move
+def search_root_move(spec, code, depth, alpha, search):
+    global _worker_search
+    searcher = _worker_ai
+    if search != _worker_search:
+        # The shared table is aged by the main process
+        searcher.new_search(age_table=not _worker_shared)
+        _worker_search = search
+    searcher.set_game_as_root(game_from_spec(spec))
+    searcher.nodes = 0
+    move = next(move for move in searcher.next_moves() if move.code() == code)
+    try:
+        if searcher.make_move(move):
+            score = -searcher.evaluate_current()
+        else:
+            score = -searcher.search(-float('inf'), -alpha, depth-1, ply=1)
+    finally:
+        searcher.undo_move(move)
+    return score, searcher.nodes
+
+
+class ParallelAI:
+    def __init__(self, game=None, workers=None, tt_bits=18, shared_tt=True):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.tt_bits = tt_bits
+        self.table = SharedTranspositionTable(tt_bits) if shared_tt else None
+        self.ai = ai.MoveUnmoveAI(tt_bits=tt_bits, tt=self.table)
+        self.pool = None
+        self.nodes = 0
+        self.search_number = 0
+        if game != None:
+            self.set_game_as_root(game)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.table is not None:
+            self.ai.tt = None
+            self.table.close()
+            self.table = None
+
+    def set_game_as_root(self, game):
+        self.game = game
+        self.spec = game_spec(game)
+        self.ai.set_game_as_root(game)
+
+    @property
+    def card_data(self):
+        return self.ai.card_data
+
+    def create_game_move(self, move):
+        return self.ai.create_game_move(move)
+
+    def find_move(self, depth):
+        self.nodes = 0
+        self.search_number += 1
+        self.ai.new_search()
+        best_move = None
+        for d in range(1, depth+1):
+            best_move, self.score = self.search_root(d, best_move)
+            self.completed_depth = d
+            if abs(self.score) == float('inf'):
+                break
+        return best_move
+
+    # Search the root to depth, trying previous (the best move so far) first
+    # Returns the best move and its score
+    def search_root(self, depth, previous):
+        searcher = self.ai
+        hash_move = previous.code() if previous is not None else None
+        moves = list(searcher.move_selector(searcher.next_moves(), searcher.active_player, hash_move))
+        if depth == 1 or self.workers <= 1 or len(moves) < 2 or self.ai.root.end:
+            searcher.best_move = previous
+            searcher.nodes = 0
+            score = searcher.search(-float('inf'), float('inf'), depth)
+            self.nodes += searcher.nodes
+            return searcher.best_move, score
+        # Eldest brother first, serially
+        best_move = moves[0]
+        searcher.nodes = 0
+        try:
+            if searcher.make_move(best_move):
+                alpha = -searcher.evaluate_current()
+            else:
+                alpha = -searcher.search(-float('inf'), float('inf'), depth-1, ply=1)
+        finally:
+            searcher.undo_move(best_move)
+        self.nodes += searcher.nodes
+        if alpha == float('inf'):
+            return best_move, alpha
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(self.table, self.tt_bits))
+        queue = moves[1:]
+        pending = dict()
+        while queue or pending:
+            while queue and len(pending) < self.workers:
+                move = queue.pop(0)
+                future = self.pool.submit(search_root_move, self.spec, move.code(), depth, alpha,
+                                          self.search_number)
+                pending[future] = move
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                move = pending.pop(future)
+                score, nodes = future.result()
+                self.nodes += nodes
+                if score > alpha:
+                    alpha = score
+                    best_move = move
+        return best_move, alpha
@@ -1,33 +1,399 @@
-import onitama as oni
-import timeit
+'''
+Benchmarks for the AI
+
+    python profiler.py                        run everything, print a summary
+    python profiler.py --json                 print the results as JSON instead
+    python profiler.py --save base.json       also write the JSON results to a file
+    python profiler.py --compare base.json    flag throughput regressions against saved results
+
+Each reference position in POSITIONS is a card set plus a move string
+(in Move.parse_moves notation) played from the starting board, along with
+its perft counts: the number of positions exactly d plies ahead, for each depth d.
+Both AIs must reproduce these counts before any timings are reported.
+
+Throughput is measured separately for
+    mock_search   full tree expansion (nodes/s)
+    alphabeta     find_move at a fixed depth (nodes/s)
+    evaluate      leaf evaluation, incremental and full (evaluations/s)
+    legal_moves   onitama.Game move queries as made by the GUI (queries/s)
+    evaluate_batch  BatchEvaluator on the same positions as evaluate, if numpy
+                  is installed (evaluations/s)
+    game_moves    full tree expansion with Game.do_move/undo_move (nodes/s)
+
+Move ordering is reported as the node count and the rate of beta cutoffs on
+the first move searched, with the killer/history heuristics off and on.
+Search algorithms (see ai.ALGORITHMS) are compared by node count, with
+and without aspiration windows.
+
+With --workers 2,4,8 the parallel search (parallel.ParallelAI) is also timed
+at --parallel-depth on every position, and its speedup over one worker reported.
+--private-tt gives each worker a table of its own instead of the shared one
+'''
+import argparse
+import json
 import sys
+import timeit
+import onitama as oni
 import ai
+from evaluators import get_evaluator, batch_row, BatchEvaluator, np
+from parallel import ParallelAI
+
+POSITIONS = [
+    {
+        'name': 'opening',
+        'cards': ['monkey', 'elephant', 'crane', 'mantis', 'tiger'],
+        'moves': '',
+        'perft': [1, 13, 208, 2352, 36686],
+    },
+    {
+        'name': 'opening-dragon',
+        'cards': ['dragon', 'rooster', 'goose', 'ox', 'crab'],
+        'moves': '',
+        'perft': [1, 9, 90, 1190, 14592],
+    },
+    {
+        'name': 'middlegame',
+        'cards': ['dragon', 'rooster', 'goose', 'ox', 'crab'],
+        'moves': 'c5-c4 [ox] b1-d2 [dragon] a5-c5 [crab] d2-d3 [ox] c4-d3 [goose] c1-b1 [rooster]',
+        'perft': [1, 16, 176, 2930, 32590],
+    },
+    {
+        'name': 'middlegame-2',
+        'cards': ['boar', 'eel', 'cobra', 'horse', 'frog'],
+        'moves': 'd1-c2 [eel] c5-b4 [cobra] a1-a2 [boar] b4-a4 [eel] f1-d2 [frog] d5-d4 [boar] c2-d3 [cobra] d4-d3 [horse]',
+        'perft': [1, 14, 191, 2744, 42098],
+    },
+    {
+        'name': 'middlegame-3',
+        'cards': ['monkey', 'crab', 'tiger', 'elephant', 'rabbit'],
+        'moves': 'c5-c3 [tiger] d1-f2 [monkey] f5-d4 [rabbit] a1-a2 [crab] d5-f4 [elephant] a2-a1 [tiger] c3-f3 [crab] c1-b2 [elephant]',
+        'perft': [1, 16, 221, 3743, 51251],
+    },
+]
+
+def create_game(position):
+    cards = [oni.NAME_TO_CARD[name] for name in position['cards']]
+    game = oni.Game(cards)
+    if position['moves']:
+        for move in oni.Move.parse_moves(game.active_player, position['moves']):
+            game.do_move(move)
+    return game
+
+# Count the nodes at each depth of a mock search, for both AIs
+def perft(game, depth):
+    counts = dict()
+    for version in ['unmove', 'copy']:
+        searcher = ai.create_ai(version, game)
+        searcher.mock_search(depth)
+        counts[version] = [len(searcher.get_nodes(d)) for d in range(depth+1)]
+    return counts
+
+def check_perft(depth):
+    failures = []
+    for position in POSITIONS:
+        known = position['perft'][:depth+1]
+        counts = perft(create_game(position), len(known)-1)
+        for version, result in counts.items():
+            if result != known:
+                failures.append('{} ({}): expected {}, got {}'.format(
+                    position['name'], version, known, result))
+    return failures
+
+def bench_mock_search(game, depth, version):
+    searcher = ai.create_ai(version, game)
+    time = timeit.timeit(stmt=lambda: searcher.mock_search(depth), number=1)
+    nodes = sum(len(searcher.get_nodes(d)) for d in range(depth+1))
+    return nodes, time
+
+def bench_alphabeta(game, depth):
+    searcher = ai.create_ai('unmove', game)
+    time = timeit.timeit(stmt=lambda: searcher.find_move(depth=depth), number=1)
+    return searcher.nodes, time
+
+# Time both evaluators on every position up to two plies from game
+def bench_evaluate(game, repeat):
+    searcher = ai.create_ai('unmove', game)
+    full = get_evaluator(searcher)
+    evaluations = 0
+    incremental_time = 0
+    full_time = 0
+    def walk(depth):
+        nonlocal evaluations, incremental_time, full_time
+        player = searcher.active_player
+        incremental_time += timeit.timeit(stmt=searcher.evaluate_current, number=repeat)
+        full_time += timeit.timeit(stmt=lambda: full.evaluate(player), number=repeat)
+        evaluations += repeat
+        if depth == 0:
+            return
+        for move in searcher.next_moves():
+            searcher.do_move(move, searcher.root)
+            walk(depth-1)
+            searcher.undo_move(move)
+    walk(2)
+    return evaluations, incremental_time, full_time
+
+# Score every position up to three plies from game in one batch
+def bench_evaluate_batch(game, repeat):
+    searcher = ai.create_ai('unmove', game)
+    rows = []
+    def walk(depth):
+        rows.append(batch_row(searcher))
+        if depth == 0:
+            return
+        for move in searcher.next_moves():
+            searcher.do_move(move, searcher.root)
+            walk(depth-1)
+            searcher.undo_move(move)
+    walk(3)
+    boards, cards, players = (np.array(column) for column in zip(*rows))
+    boards = boards.astype(np.int8)
+    batch = BatchEvaluator()
+    time = timeit.timeit(stmt=lambda: batch.evaluate(boards, cards, players), number=repeat)
+    return len(rows)*repeat, time
+
+# The queries the GUI makes on a click: sources, then targets and card
+# choices for every source, repeated on an unchanged position
+def bench_legal_moves(game, repeat):
+    queries = 0
+    def click():
+        nonlocal queries
+        for start in game.legal_move_sources():
+            for end in game.legal_move_targets(start):
+                game.get_card_choices_for_move(start, end)
+                queries += 1
+            queries += 1
+        queries += 1
+    time = timeit.timeit(stmt=click, number=repeat)
+    return queries, time
+
+# Walk the tree to depth using only the public Game API, as analysis tools do
+def bench_game_moves(game, depth):
+    game = game.clone()
+    nodes = 0
+    def walk(depth):
+        nonlocal nodes
+        nodes += 1
+        if depth == 0:
+            return
+        player = game.active_player
+        for card, targets in list(game.legal_moves().items()):
+            for start, ends in list(targets.items()):
+                for end in ends:
+                    game.do_move(oni.Move(player, start, end, card))
+                    walk(depth-1)
+                    game.undo_move()
+    time = timeit.timeit(stmt=lambda: walk(depth), number=1)
+    return nodes, time
+
+# Nodes and first-move cutoff rate with the killer and history heuristics off, then on
+def bench_ordering(game, depth):
+    result = dict()
+    for name, enabled in [('plain', False), ('heuristics', True)]:
+        searcher = ai.MoveUnmoveAI(game, killer_moves=enabled, history_heuristic=enabled)
+        searcher.find_move(depth=depth)
+        result[name] = {
+            'nodes': searcher.nodes,
+            'first_move_cutoff_rate': searcher.first_move_cutoffs/max(searcher.cutoffs, 1),
+        }
+    result['node_reduction'] = 1 - result['heuristics']['nodes']/result['plain']['nodes']
+    return result
+
+# Nodes searched by each algorithm, with and without aspiration windows
+ALGORITHM_CONFIGS = [
+    ('alphabeta', None),
+    ('alphabeta', 0.25),
+    ('pvs', None),
+    ('pvs', 0.25),
+]
+
+def bench_algorithms(game, depth):
+    result = dict()
+    for algorithm, aspiration in ALGORITHM_CONFIGS:
+        searcher = ai.MoveUnmoveAI(game, algorithm=algorithm, aspiration=aspiration)
+        searcher.find_move(depth=depth)
+        name = algorithm if aspiration is None else '{}+aspiration'.format(algorithm)
+        result[name] = {'nodes': searcher.nodes, 'score': searcher.score,
+                        'ebf': searcher.stats.effective_branching_factor}
+    return result
+
+# Depth reached and nodes searched in the same time budget with each kind of
+# forward pruning on its own, and all together
+PRUNING_CONFIGS = [
+    ('none', dict()),
+    ('null_move', dict(null_move=True)),
+    ('lmr', dict(late_move_reductions=True)),
+    ('futility', dict(futility=True)),
+    ('all', dict(null_move=True, late_move_reductions=True, futility=True)),
+]
+
+def bench_pruning(game, time_limit):
+    result = dict()
+    for name, options in PRUNING_CONFIGS:
+        searcher = ai.MoveUnmoveAI(game, **options)
+        searcher.find_move(time_limit=time_limit)
+        result[name] = {'depth': searcher.completed_depth, 'nodes': searcher.nodes, 'score': searcher.score}
+    return result
 
-game = oni.Game(start_cards=oni.ALL_CARDS[0:5])
-ai_copy = ai.create_ai('copy', game)
-ai_unmove = ai.create_ai('unmove', game)
-depth = int(sys.argv[1])
+def bench_parallel(game, depth, workers, shared_tt=True):
+    with ParallelAI(game, workers=workers, shared_tt=shared_tt) as searcher:
+        # Start the worker processes before timing
+        if workers > 1:
+            searcher.find_move(depth=2)
+        time = timeit.timeit(stmt=lambda: searcher.find_move(depth=depth), number=1)
+        return searcher.nodes, time
 
-def compute():
-    ai_copy.mock_search(depth=depth, mode=sys.argv[2])
+# Total time over all positions for each worker count, and the speedup over one worker
+def run_parallel(depth, worker_counts, shared_tt=True):
+    results = dict()
+    worker_counts = sorted(set([1] + worker_counts))
+    for workers in worker_counts:
+        nodes, time = 0, 0
+        for position in POSITIONS:
+            n, t = bench_parallel(create_game(position), depth, workers, shared_tt)
+            nodes += n
+            time += t
+        results[str(workers)] = {'count': nodes, 'seconds': time, 'per_second': nodes/time}
+    for result in results.values():
+        result['speedup'] = results['1']['seconds']/result['seconds']
+    return results
 
-def compute2():
-    ai_unmove.mock_search(depth=depth)
+def run(perft_depth, search_depth, eval_repeat, pruning_time):
+    results = {
+        'perft_depth': perft_depth,
+        'search_depth': search_depth,
+        'pruning_time': pruning_time,
+        'positions': dict(),
+        'totals': dict(),
+        'ordering': dict(),
+        'algorithms': dict(),
+        'pruning': dict(),
+    }
+    totals = dict()
+    def add(name, count, time):
+        count_total, time_total = totals.get(name, (0, 0))
+        totals[name] = count_total + count, time_total + time
+        return {'count': count, 'seconds': time, 'per_second': count/time if time else 0}
+    for position in POSITIONS:
+        game = create_game(position)
+        entry = dict()
+        for version in ['unmove', 'copy']:
+            nodes, time = bench_mock_search(game, perft_depth, version)
+            entry['mock_search_' + version] = add('mock_search_' + version, nodes, time)
+        nodes, time = bench_game_moves(game, perft_depth)
+        entry['game_moves'] = add('game_moves', nodes, time)
+        nodes, time = bench_alphabeta(game, search_depth)
+        entry['alphabeta'] = add('alphabeta', nodes, time)
+        evaluations, incremental_time, full_time = bench_evaluate(game, eval_repeat)
+        entry['evaluate'] = add('evaluate', evaluations, incremental_time)
+        entry['evaluate_full'] = add('evaluate_full', evaluations, full_time)
+        if np is not None:
+            evaluations, time = bench_evaluate_batch(game, eval_repeat)
+            entry['evaluate_batch'] = add('evaluate_batch', evaluations, time)
+        queries, time = bench_legal_moves(game, eval_repeat)
+        entry['legal_moves'] = add('legal_moves', queries, time)
+        results['positions'][position['name']] = entry
+        results['ordering'][position['name']] = bench_ordering(game, search_depth+1)
+        results['algorithms'][position['name']] = bench_algorithms(game, search_depth+2)
+        results['pruning'][position['name']] = bench_pruning(game, pruning_time)
+    for name, (count, time) in totals.items():
+        results['totals'][name] = {
+            'count': count,
+            'seconds': time,
+            'per_second': count/time if time else 0,
+        }
+    return results
 
-time = timeit.timeit(stmt=compute, number=1)
-print('{} seconds'.format(time))
+# Returns a list of (name, baseline, current, change) where throughput
+# dropped by more than threshold (a fraction of the baseline)
+def compare(baseline, results, threshold):
+    regressions = []
+    for name, current in results['totals'].items():
+        base = baseline['totals'].get(name)
+        if base is None or base['per_second'] == 0:
+            continue
+        change = current['per_second']/base['per_second'] - 1
+        if change < -threshold:
+            regressions.append((name, base['per_second'], current['per_second'], change))
+    return regressions
 
-time2 = timeit.timeit(stmt=compute2, number=1)
-print('{} seconds'.format(time2))
+def print_summary(results):
+    for name, entry in results['positions'].items():
+        print(name)
+        for bench, result in entry.items():
+            print('    {:20} {:10} in {:7.3f}s  {:10.1f} k/s'.format(
+                bench, result['count'], result['seconds'], result['per_second']/1000))
+    print('total')
+    for bench, result in results['totals'].items():
+        print('    {:20} {:10} in {:7.3f}s  {:10.1f} k/s'.format(
+            bench, result['count'], result['seconds'], result['per_second']/1000))
+    print('move ordering, depth {}'.format(results['search_depth']+1))
+    for name, result in results['ordering'].items():
+        print('    {:20} nodes {:8} -> {:8} ({:+.1%})  first move cutoffs {:.1%} -> {:.1%}'.format(
+            name, result['plain']['nodes'], result['heuristics']['nodes'], -result['node_reduction'],
+            result['plain']['first_move_cutoff_rate'], result['heuristics']['first_move_cutoff_rate']))
+    print('search algorithms, depth {} (nodes)'.format(results['search_depth']+2))
+    for name, result in results['algorithms'].items():
+        print('    {:20} '.format(name) + '  '.join(
+            '{} {}'.format(algorithm, r['nodes']) for algorithm, r in result.items()))
+    print('forward pruning, {}s per search (depth/nodes)'.format(results['pruning_time']))
+    for name, result in results['pruning'].items():
+        print('    {:20} '.format(name) + '  '.join(
+            '{} {}/{}'.format(config, r['depth'], r['nodes']) for config, r in result.items()))
+    if 'parallel' in results:
+        print('parallel search, depth {}'.format(results['parallel_depth']))
+        for workers, result in results['parallel'].items():
+            print('    {:>3} workers {:10} nodes in {:7.3f}s  speedup {:5.2f}'.format(
+                workers, result['count'], result['seconds'], result['speedup']))
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Onitama AI benchmarks')
+    parser.add_argument('--perft-depth', type=int, default=4,
+                        help='depth for perft checks and mock_search timings')
+    parser.add_argument('--search-depth', type=int, default=4,
+                        help='depth for alphabeta timings')
+    parser.add_argument('--eval-repeat', type=int, default=20,
+                        help='evaluations per sampled position')
+    parser.add_argument('--pruning-time', type=float, default=1.0,
+                        help='seconds per search when comparing forward pruning')
+    parser.add_argument('--workers', type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated worker counts for the parallel search')
+    parser.add_argument('--parallel-depth', type=int, default=5,
+                        help='depth for parallel search timings')
+    parser.add_argument('--private-tt', action='store_true',
+                        help='one transposition table per parallel worker, not a shared one')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--save', metavar='FILE', help='write JSON results to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='baseline JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='throughput drop (fraction) that counts as a regression')
+    args = parser.parse_args(argv)
 
-nodes = 0
-nodes2 = 0
-for i in range(depth+1):
-    nodes += len(ai_copy.get_nodes(i))
-    nodes2 += len(ai_unmove.get_nodes(i))
-print('{} nodes'.format(nodes))
-print('{} kilonodes/s'.format(nodes/time/1000))
+    failures = check_perft(args.perft_depth)
+    if failures:
+        for failure in failures:
+            print('perft mismatch: ' + failure, file=sys.stderr)
+        return 2
+    results = run(args.perft_depth, args.search_depth, args.eval_repeat, args.pruning_time)
+    if args.workers:
+        results['parallel_depth'] = args.parallel_depth
+        results['parallel'] = run_parallel(args.parallel_depth, args.workers, not args.private_tt)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_summary(results)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for name, base, current, change in regressions:
+            print('REGRESSION {}: {:.1f} -> {:.1f} k/s ({:+.1%})'.format(
+                name, base/1000, current/1000, change), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
 
-print('{} nodes'.format(nodes2))
-print('{} kilonodes/s'.format(nodes2/time2/1000))
+if __name__ == '__main__':
+    sys.exit(main())
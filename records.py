@@ -0,0 +1,238 @@
+'''
+Compact binary game records
+
+A record file is MAGIC followed by records, one per game:
+    5 bytes     start card indices into onitama.ALL_CARDS, in start_cards order
+    uint16      number of moves
+    1 byte/move bits 0-4: start square (x + 5*y)
+                bit 5: which card of the mover's hand was played, by its index
+                       in Game.cards (hands keep the order do_move leaves them in)
+                bits 6-7: index of the move in the card's sorted displacements
+                          for the mover, see card_vectors
+The end square follows from the start square and the displacement, and the
+player from whose turn it is, so a record can be decoded without a board.
+
+RecordReader memory-maps a file and decodes records lazily, so files much
+larger than memory can be scanned. The text form of a game is five card names
+followed by its moves in Move.parse_moves notation:
+
+    tiger monkey crab boar mantis c5-c4 [crab] b1-b2 [tiger]
+
+    python records.py convert games.txt -o games.bin
+    python records.py dump games.bin
+
+convert also reads the JSON lines written by arena.py.
+'''
+import argparse
+import json
+import mmap
+import struct
+import sys
+import onitama as oni
+
+MAGIC = b'ONIGR\x00\x01\x00'
+HEADER = struct.Struct('<5BH')
+
+
+class RecordError(Exception):
+    pass
+
+
+# A card's displacements for player, in the order used by the move codes
+def card_vectors(card, player):
+    return sorted(card.moves[player])
+
+# The players' hands and the side to move through a game, changed by
+# played(card) as do_move would change them
+class Hands:
+    def __init__(self, start_cards):
+        self.cards = {
+            oni.Player.RED: list(start_cards[0:2]),
+            oni.Player.BLUE: list(start_cards[2:4]),
+        }
+        self.neutral_card = start_cards[4]
+        self.player = self.neutral_card.start_player
+
+    def played(self, card):
+        hand = self.cards[self.player]
+        hand.append(self.neutral_card)
+        hand.remove(card)
+        self.neutral_card = card
+        self.player = self.player.other()
+
+def encode_moves(start_cards, moves):
+    hands = Hands(start_cards)
+    codes = bytearray()
+    for move in moves:
+        if move.player != hands.player or move.card not in hands.cards[move.player]:
+            raise RecordError('move out of turn or with a card not in hand')
+        try:
+            vector = card_vectors(move.card, move.player).index(move.displacement())
+        except ValueError:
+            raise RecordError('move does not match its card')
+        start = move.start[0] + 5*move.start[1]
+        choice = hands.cards[move.player].index(move.card)
+        codes.append(start | choice << 5 | vector << 6)
+        hands.played(move.card)
+    return bytes(codes)
+
+def decode_moves(start_cards, codes):
+    hands = Hands(start_cards)
+    moves = []
+    for code in codes:
+        start = code & 31
+        if start >= 25:
+            raise RecordError('bad move code: {}'.format(code))
+        card = hands.cards[hands.player][code >> 5 & 1]
+        vectors = card_vectors(card, hands.player)
+        if code >> 6 >= len(vectors):
+            raise RecordError('bad move code: {}'.format(code))
+        u, v = vectors[code >> 6]
+        x, y = start % 5, start // 5
+        moves.append(oni.Move(hands.player, (x, y), (x+u, y+v), card))
+        hands.played(card)
+    return moves
+
+def encode_game(start_cards, moves):
+    if len(moves) > 0xFFFF:
+        raise RecordError('too many moves: {}'.format(len(moves)))
+    header = HEADER.pack(*[oni.CARD_IDS[card.name()] for card in start_cards], len(moves))
+    return header + encode_moves(start_cards, moves)
+
+# Replay moves into a new Game, checking that they are legal
+def create_game(start_cards, moves):
+    game = oni.Game(list(start_cards))
+    for move in moves:
+        game.do_move(move)
+    return game
+
+
+class RecordWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def write(self, start_cards, moves):
+        self.file.write(encode_game(start_cards, moves))
+        self.count += 1
+
+    def write_game(self, game):
+        self.write(game.start_cards, game.moves)
+
+
+class RecordReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise RecordError('not a game record file: {}'.format(path))
+        # Files with no records cannot be memory-mapped
+        self.map = None
+        if self.file.seek(0, 2) > len(MAGIC):
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    # Yields (start_cards, moves) for each game, decoding as it goes
+    def records(self):
+        if self.map is None:
+            return
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset < end:
+            if offset + HEADER.size > end:
+                raise RecordError('truncated record at offset {}'.format(offset))
+            *card_ids, count = HEADER.unpack_from(self.map, offset)
+            offset += HEADER.size
+            if offset + count > end:
+                raise RecordError('truncated record at offset {}'.format(offset))
+            try:
+                start_cards = [oni.ALL_CARDS[i] for i in card_ids]
+            except IndexError:
+                raise RecordError('bad card index at offset {}'.format(offset))
+            yield start_cards, decode_moves(start_cards, self.map[offset:offset+count])
+            offset += count
+
+    # Yields each game as an onitama.Game, replayed move by move
+    def games(self):
+        for start_cards, moves in self.records():
+            yield create_game(start_cards, moves)
+
+    def __iter__(self):
+        return self.games()
+
+
+# The text form of a game, see the top of this file
+def format_game(start_cards, moves):
+    names = ' '.join(card.name() for card in start_cards)
+    return names + (' ' + oni.Move.format_moves(moves) if moves else '')
+
+def parse_game(line):
+    line = line.strip()
+    if line.startswith('{'):
+        record = json.loads(line)
+        names, move_string = record['cards'], record['moves']
+    else:
+        words = line.split(' ', 5)
+        names, move_string = words[:5], words[5] if len(words) > 5 else ''
+    try:
+        start_cards = [oni.NAME_TO_CARD[name.lower()] for name in names]
+    except KeyError:
+        raise oni.MoveParseError
+    if len(start_cards) != 5:
+        raise oni.MoveParseError
+    moves = oni.Move.parse_moves(start_cards[4].start_player, move_string) if move_string else []
+    return start_cards, moves
+
+# Convert lines of text games to a record file, returns the number of games
+def convert(lines, path):
+    with RecordWriter(path) as writer:
+        for line in lines:
+            if line.strip():
+                writer.write(*parse_game(line))
+        return writer.count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert and print binary game records')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('convert', help='text games (or arena JSON lines) to records')
+    command.add_argument('input', help='text file, - for stdin')
+    command.add_argument('-o', '--output', required=True, help='record file to write')
+    command = commands.add_parser('dump', help='print the games in a record file as text')
+    command.add_argument('input', help='record file')
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        if args.input == '-':
+            count = convert(sys.stdin, args.output)
+        else:
+            with open(args.input) as f:
+                count = convert(f, args.output)
+        print('{} games'.format(count))
+    else:
+        with RecordReader(args.input) as reader:
+            for start_cards, moves in reader.records():
+                print(format_game(start_cards, moves))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
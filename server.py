@@ -0,0 +1,287 @@
+'''
+Asyncio analysis server: many clients, a bounded pool of search processes
+
+Clients connect over TCP (or a Unix socket with --unix) and send requests as
+JSON objects, one per line:
+
+    {"id": 1, "cards": ["tiger", "monkey", "crab", "boar", "mantis"], "moves": "c1-c3 [tiger]", "depth": 6}
+    {"id": 2, "cards": ["tiger", "monkey", "crab", "boar", "mantis"], "time": 0.5}
+
+cards are in start_cards order and moves in Move.parse_moves notation, as for
+engine.py. depth and time limit the search, depth DEFAULT_DEPTH if neither is
+given. Replies are JSON objects, one per line, carrying the request's id:
+
+    {"id": 1, "type": "depth", "depth": 3, "score": 0.11, "nodes": 314, "time": 0.004, "pv": ["b1-b3 [tiger]", ...]}
+    {"id": 1, "type": "result", "move": "b1-b3 [tiger]", "depth": 6, ...}
+    {"id": 1, "type": "error", "error": "unknown card: ox"}
+
+One "depth" line is sent as each iteration completes, then a "result" line
+(move is null when the game is over). Scores are from the side to move's point
+of view, "mate" or "-mate" for a forced result. Requests on one connection
+are answered concurrently, so replies to different ids may interleave.
+
+Searches run in a process pool, each worker keeping one MoveUnmoveAI and its
+transposition table for its lifetime. A request identical to one already being
+searched joins it instead of starting another search, and is sent the depths
+completed so far. At most max_pending searches are queued or running: past that,
+the server stops reading from a connection until a search finishes, so clients
+that send faster than the pool can search are slowed down by TCP flow control
+instead of growing the queue.
+
+    python server.py --port 7421 --workers 4
+'''
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import ai
+import engine
+
+DEFAULT_PORT = 7421
+DEFAULT_DEPTH = engine.DEFAULT_DEPTH
+MAX_DEPTH = 20
+MAX_TIME = 60
+
+def json_score(score):
+    if abs(score) == float('inf'):
+        return engine.format_score(score)
+    return score
+
+# A reply for the searcher's last completed depth
+def search_message(searcher, kind):
+    stats = searcher.stats
+    return {
+        'type': kind,
+        'depth': searcher.completed_depth,
+        'score': json_score(searcher.score) if searcher.score is not None else None,
+        'nodes': stats.nodes,
+        'time': stats.seconds,
+        'pv': [searcher.create_game_move(move).notation() for move in searcher.principal_variation],
+    }
+
+# engine.parse_position arguments for cards and a move string
+def position_words(cards, moves):
+    return ['cards'] + list(cards) + (['moves'] + moves.split() if moves else [])
+
+# The JSON object on a request line
+def parse_request(line):
+    try:
+        request = json.loads(line)
+    except ValueError:
+        raise engine.ProtocolError('not JSON')
+    if not isinstance(request, dict):
+        raise engine.ProtocolError('expected a JSON object')
+    return request
+
+# Check a request and return its key. Requests with equal keys have the same
+# answer: key is (cards, moves, depth, time)
+def request_key(request):
+    cards = request.get('cards')
+    moves = request.get('moves') or ''
+    depth = request.get('depth')
+    time_limit = request.get('time')
+    if not isinstance(cards, list) or len(cards) != 5 or not all(isinstance(name, str) for name in cards):
+        raise engine.ProtocolError('expected five card names')
+    if not isinstance(moves, str):
+        raise engine.ProtocolError('expected moves as a string')
+    if depth is not None and (not isinstance(depth, int) or not 1 <= depth <= MAX_DEPTH):
+        raise engine.ProtocolError('depth must be from 1 to {}'.format(MAX_DEPTH))
+    if time_limit is not None and (not isinstance(time_limit, (int, float)) or not 0 < time_limit <= MAX_TIME):
+        raise engine.ProtocolError('time must be more than 0 and at most {}'.format(MAX_TIME))
+    if depth is None and time_limit is None:
+        depth = DEFAULT_DEPTH
+    cards = tuple(name.lower() for name in cards)
+    moves = ' '.join(moves.split())
+    # Raises ProtocolError for bad cards or moves, before a worker is involved
+    engine.parse_position(position_words(cards, moves))
+    return cards, moves, depth, time_limit
+
+
+_worker_ai = None
+_worker_progress = None
+
+def init_worker(progress, options):
+    global _worker_ai, _worker_progress
+    _worker_ai = ai.MoveUnmoveAI(**options)
+    _worker_progress = progress
+
+# Runs in a worker: search the position of a request key. Depth and result
+# messages go to the progress queue, in order, as (kind, key, message)
+def analyse(key):
+    cards, moves, depth, time_limit = key
+    searcher = _worker_ai
+    searcher.set_game_as_root(engine.parse_position(position_words(cards, moves)))
+    def progress(searcher):
+        _worker_progress.put(('depth', key, search_message(searcher, 'depth')))
+    move = searcher.find_move(
+        max_depth=depth if depth is not None else MAX_DEPTH,
+        time_limit=time_limit, progress=progress)
+    message = search_message(searcher, 'result')
+    message['move'] = searcher.create_game_move(move).notation() if move is not None else None
+    _worker_progress.put(('result', key, message))
+
+
+# A search in flight and the queues of the requests waiting on it
+class Job:
+    def __init__(self):
+        self.updates = []
+        self.subscribers = []
+
+
+class AnalysisServer:
+    def __init__(self, workers=None, max_pending=None, engine_options=None):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.max_pending = max_pending if max_pending is not None else 4 * self.workers
+        self.engine_options = engine_options or dict()
+        self.jobs = dict()
+        self.requests = 0
+        self.searches = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT, path=None):
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.max_pending)
+        # Forked workers would inherit the open client sockets, and keep them
+        # open after the server has closed them
+        context = multiprocessing.get_context('forkserver')
+        self.progress = context.Queue()
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context, initializer=init_worker,
+            initargs=(self.progress, self.engine_options))
+        self.reader = threading.Thread(target=self.read_progress, daemon=True)
+        self.reader.start()
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.loop.run_in_executor(None, self.pool.shutdown)
+        self.progress.put(None)
+        await self.loop.run_in_executor(None, self.reader.join)
+
+    # Runs in a thread: hand the workers' messages over to the event loop
+    def read_progress(self):
+        while True:
+            item = self.progress.get()
+            if item is None:
+                return
+            self.loop.call_soon_threadsafe(self.publish, *item)
+
+    def publish(self, kind, key, message):
+        if kind == 'result':
+            self.finish(key, message)
+            return
+        job = self.jobs.get(key)
+        if job is not None:
+            job.updates.append(message)
+            for queue in job.subscribers:
+                queue.put_nowait(message)
+
+    def finish(self, key, message):
+        job = self.jobs.pop(key, None)
+        if job is not None:
+            for queue in job.subscribers:
+                queue.put_nowait(message)
+
+    def search_done(self, key, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            self.finish(key, {'type': 'error', 'error': 'search failed: {}'.format(future.exception())})
+
+    # A queue of the replies for key, starting a search unless one is in flight.
+    # Waits while max_pending searches are queued or running
+    async def subscribe(self, key):
+        self.requests += 1
+        job = self.jobs.get(key)
+        if job is None:
+            await self.slots.acquire()
+            # Another request may have started the same search meanwhile
+            job = self.jobs.get(key)
+            if job is None:
+                job = self.jobs[key] = Job()
+                self.searches += 1
+                future = self.loop.run_in_executor(self.pool, analyse, key)
+                future.add_done_callback(functools.partial(self.search_done, key))
+            else:
+                self.slots.release()
+        queue = asyncio.Queue()
+        for message in job.updates:
+            queue.put_nowait(message)
+        job.subscribers.append(queue)
+        return queue
+
+    async def handle_client(self, reader, writer):
+        lock = asyncio.Lock()
+        async def send(message):
+            async with lock:
+                writer.write((json.dumps(message) + '\n').encode())
+                await writer.drain()
+        async def stream(request_id, queue):
+            while True:
+                message = await queue.get()
+                await send(dict(message, id=request_id))
+                if message['type'] != 'depth':
+                    return
+        tasks = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                # Errors carry the request's id, once it has been read
+                request_id = None
+                try:
+                    request = parse_request(line)
+                    request_id = request.get('id')
+                    key = request_key(request)
+                except engine.ProtocolError as e:
+                    await send({'id': request_id, 'type': 'error', 'error': str(e)})
+                    continue
+                queue = await self.subscribe(key)
+                tasks.append(asyncio.ensure_future(stream(request_id, queue)))
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            for task in tasks:
+                task.cancel()
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    server = AnalysisServer(args.workers, args.max_pending, {'tt_bits': args.tt_bits})
+    listener = await server.start(args.host, args.port, args.unix)
+    try:
+        await listener.serve_forever()
+    finally:
+        await server.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve position analysis as JSON lines')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, help='search processes (default: one per CPU)')
+    parser.add_argument('--max-pending', type=int,
+                        help='searches queued or running before reading stops (default: 4 per worker)')
+    parser.add_argument('--tt-bits', type=int, default=20, help='transposition table size per worker, log 2')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+'''
+Symmetries of Onitama positions
+
+Two transformations turn a position into an equivalent one:
+    mirror  reflect the board left to right (x -> 4-x) and replace every card
+            by its mirror image, the card whose moves are reflected the same way
+            (frog <-> rabbit, goose <-> rooster, eel <-> cobra, horse <-> ox,
+            the symmetric cards map to themselves)
+    swap    turn the board 180 degrees and swap colours: red pieces become blue
+            ones and the other way round, the hands are exchanged, and the other
+            player is to move. Cards stay as they are, since blue's moves are
+            red's turned 180 degrees
+Both are their own inverse, and they commute.
+
+canonical picks one representative per class: the side to move is made red
+with swap, then the smaller of the position and its mirror is taken. Tables
+keyed by canonical_hash hold each class once, and moves found for the
+canonical position are taken back to the real one with transform_square
+and, for cards, MIRROR_CARD.
+
+Positions are in the AI's representation (see MoveUnmoveAI): a board of
+25 piece values, card names in cards order (red, red, blue, blue, neutral)
+and the player to move.
+'''
+import onitama as oni
+from constants import *
+from transposition import PIECE_KEYS, CARD_KEYS, NEUTRAL
+
+# The card whose moves are card's reflected left to right
+def mirrored_card(card):
+    moves = {(-x, y) for x, y in card.moves[oni.Player.RED]}
+    for other in oni.ALL_CARDS:
+        if other.moves[oni.Player.RED] == moves:
+            return other
+    return None
+
+MIRROR_CARD = {card.name(): mirrored_card(card).name() for card in oni.ALL_CARDS}
+
+def transform_square(square, swap, mirror):
+    if swap:
+        square = 24 - square
+    if mirror:
+        square = square - square % 5 + 4 - square % 5
+    return square
+
+# Returns (board, names, player) with the transformation applied
+def transform_position(board, names, player, swap, mirror):
+    result = [EMPTY] * 25
+    for square, piece in enumerate(board):
+        if piece != EMPTY:
+            result[transform_square(square, swap, mirror)] = -piece if swap else piece
+    names = list(names)
+    if swap:
+        names = names[2:4] + names[0:2] + names[4:]
+        player = 1 - player
+    if mirror:
+        names = [MIRROR_CARD[name] for name in names]
+    return result, names, player
+
+# Returns (key, (swap, mirror)): key identifies the class of the position and
+# is the canonical position itself, with red to move and each hand sorted:
+# (board tuple, red's names, blue's names, neutral name).
+# (swap, mirror) takes the position to the canonical one, and back
+def canonical(board, names, player):
+    swap = player == BLUE
+    best = None
+    for mirror in (False, True):
+        transformed, transformed_names, _ = transform_position(board, names, player, swap, mirror)
+        key = (
+            tuple(transformed),
+            tuple(sorted(transformed_names[0:2])),
+            tuple(sorted(transformed_names[2:4])),
+            transformed_names[4],
+        )
+        if best is None or key < best[0]:
+            best = key, (swap, mirror)
+    return best
+
+# Zobrist hash (see transposition.py) of a canonical key, as zobrist_hash
+# would give for the canonical position
+def canonical_hash(key):
+    board, red, blue, neutral = key
+    result = 0
+    for square, piece in enumerate(board):
+        if piece != EMPTY:
+            result ^= PIECE_KEYS[piece][square]
+    for name in red:
+        result ^= CARD_KEYS[name][RED]
+    for name in blue:
+        result ^= CARD_KEYS[name][BLUE]
+    return result ^ CARD_KEYS[neutral][NEUTRAL]
+
+# canonical() for the AI's current position
+def canonical_position(searcher):
+    names = [searcher.card_data[card].name for card in searcher.cards]
+    return canonical(searcher.board, names, searcher.active_player)
@@ -0,0 +1,322 @@
+'''
+Endgame tablebases, generated by retrograde analysis
+
+A table covers every position with a given set of five cards in which each
+side has its king and at most max_pieces-1 pawns, for every placement of the
+cards and either side to move. Positions already won (a king captured or
+on its goal square) are not stored.
+
+Moves are those the AI generates (see MoveUnmoveAI.next_moves), so a side
+with no legal move is lost, as it is in the search.
+
+Each position stores one uint16: 0 for a draw (neither side can force a win),
+otherwise 1 + the number of plies to the end of the game with best play.
+That distance is odd when the side to move wins and even when it loses.
+
+File layout: MAGIC, a uint32 header length, a JSON header with the card names
+and max_pieces, padding to an even offset, then the uint16 values.
+The values are memory-mapped, not read, when a table is opened.
+
+Generation keeps a few bytes per position: --pieces 1 has 33 thousand
+positions, --pieces 2 18 million (a 37 MB file, about 9 minutes and 180 MB
+of memory to generate) and --pieces 3 over 2 billion, too many to generate.
+
+    python tablebase.py tiger monkey crab boar mantis --pieces 1 -o kings.tb
+'''
+import argparse
+from array import array
+from itertools import combinations
+import json
+import mmap
+import struct
+import sys
+import ai
+from constants import *
+
+MAGIC = b'ONITB\x00\x01\x00'
+
+# Score given to a won position at distance 0, from the side to move's point
+# of view, and reduced by the distance so that faster wins are preferred.
+# Well above anything Evaluator returns short of an actual victory
+TB_WIN = 1000
+
+
+class TableBaseError(Exception):
+    pass
+
+
+# Every (red king, blue king, red pawns, blue pawns) placement in the table
+def layouts(max_pieces):
+    for red_king in range(25):
+        if red_king == REDGOAL:
+            continue
+        for blue_king in range(25):
+            if blue_king == red_king or blue_king == BLUEGOAL:
+                continue
+            free = [sq for sq in range(25) if sq != red_king and sq != blue_king]
+            for red_count in range(max_pieces):
+                for red_pawns in combinations(free, red_count):
+                    rest = [sq for sq in free if sq not in red_pawns]
+                    for blue_count in range(max_pieces):
+                        for blue_pawns in combinations(rest, blue_count):
+                            yield red_king, blue_king, red_pawns, blue_pawns
+
+# Every placement of the five cards (indices 0-4) as
+# (red's pair, blue's pair, neutral), each pair sorted
+def arrangements():
+    result = []
+    for neutral in range(5):
+        hands = [card for card in range(5) if card != neutral]
+        for red in combinations(hands, 2):
+            blue = tuple(card for card in hands if card not in red)
+            result.append((red, blue, neutral))
+    return result
+
+
+class Indexer:
+    def __init__(self, max_pieces):
+        self.max_pieces = max_pieces
+        self.layouts = list(layouts(max_pieces))
+        self.layout_index = {layout: i for i, layout in enumerate(self.layouts)}
+        self.arrangements = arrangements()
+        self.arrangement_index = {cards: i for i, cards in enumerate(self.arrangements)}
+
+    def __len__(self):
+        return len(self.layouts) * len(self.arrangements) * 2
+
+    def index(self, layout, arrangement, player):
+        return ((self.layout_index[layout] * len(self.arrangements)
+                 + self.arrangement_index[arrangement]) * 2 + player)
+
+    def position(self, index):
+        index, player = divmod(index, 2)
+        layout, arrangement = divmod(index, len(self.arrangements))
+        return self.layouts[layout], self.arrangements[arrangement], player
+
+
+# Moves from a position, as a list of successor indices, or None if the side
+# to move can win immediately (capture the king or move its king to its goal)
+def successors(indexer, card_data, index):
+    (red_king, blue_king, red_pawns, blue_pawns), (red, blue, neutral), player = indexer.position(index)
+    if player == RED:
+        king, pawns, enemy_king, enemy_pawns, hand, goal = red_king, red_pawns, blue_king, blue_pawns, red, REDGOAL
+    else:
+        king, pawns, enemy_king, enemy_pawns, hand, goal = blue_king, blue_pawns, red_king, red_pawns, blue, BLUEGOAL
+    own = 1 << king
+    for sq in pawns:
+        own |= 1 << sq
+    result = []
+    for card in hand:
+        masks = card_data[card].masks[player]
+        new_hand = tuple(sorted([c for c in hand if c != card] + [neutral]))
+        cards = (new_hand, blue, card) if player == RED else (red, new_hand, card)
+        for start in SQUARES[own]:
+            for end in SQUARES[masks[start] & ~own]:
+                if end == enemy_king or (start == king and end == goal):
+                    return None
+                if start == king:
+                    new_king, new_pawns = end, pawns
+                else:
+                    new_king, new_pawns = king, tuple(sorted([sq for sq in pawns if sq != start] + [end]))
+                new_enemy_pawns = tuple(sq for sq in enemy_pawns if sq != end)
+                if player == RED:
+                    layout = (new_king, enemy_king, new_pawns, new_enemy_pawns)
+                else:
+                    layout = (enemy_king, new_king, new_enemy_pawns, new_pawns)
+                result.append(indexer.index(layout, cards, 1-player))
+    return result
+
+# Positions with a move to the position at index, as a list of their indices:
+# the side that has just moved takes back a move with the card now neutral,
+# putting back any pawn it captured. Exactly the positions whose successors
+# include index, or can win immediately instead
+def predecessors(indexer, card_data, index):
+    (red_king, blue_king, red_pawns, blue_pawns), (red, blue, neutral), player = indexer.position(index)
+    mover = 1 - player
+    if mover == RED:
+        king, pawns, enemy_king, enemy_pawns, hand, goal = red_king, red_pawns, blue_king, blue_pawns, red, REDGOAL
+    else:
+        king, pawns, enemy_king, enemy_pawns, hand, goal = blue_king, blue_pawns, red_king, red_pawns, blue, BLUEGOAL
+    own = 1 << king
+    for sq in pawns:
+        own |= 1 << sq
+    occupied = own | 1 << enemy_king
+    for sq in enemy_pawns:
+        occupied |= 1 << sq
+    # The mover's pieces that reach a square with a card are those the other
+    # player's masks reach from it
+    masks = card_data[neutral].masks[player]
+    # The card the mover played took the place of one in its hand
+    hands = [(tuple(sorted([c for c in hand if c != card] + [neutral])), card) for card in hand]
+    result = []
+    for end in SQUARES[own]:
+        for start in SQUARES[masks[end] & ~occupied]:
+            if end == king:
+                if start == goal:
+                    continue
+                old_king, old_pawns = start, pawns
+            else:
+                old_king, old_pawns = king, tuple(sorted([sq for sq in pawns if sq != end] + [start]))
+            captured = [enemy_pawns]
+            if len(enemy_pawns) < indexer.max_pieces - 1:
+                captured.append(tuple(sorted(enemy_pawns + (end,))))
+            for old_enemy_pawns in captured:
+                if mover == RED:
+                    layout = (old_king, enemy_king, old_pawns, old_enemy_pawns)
+                else:
+                    layout = (enemy_king, old_king, old_enemy_pawns, old_pawns)
+                for old_hand, old_neutral in hands:
+                    cards = (old_hand, blue, old_neutral) if mover == RED else (red, old_hand, old_neutral)
+                    result.append(indexer.index(layout, cards, mover))
+    return result
+
+# Retrograde analysis: resolve immediate wins and positions without moves,
+# then walk predecessor edges outwards in order of distance. The edges are
+# generated again as each position is resolved rather than stored, and
+# values and move counts are kept in arrays, so memory stays a few bytes
+# per position (an edge list per position needs several GB at max_pieces 2)
+def generate(card_names, max_pieces):
+    if len(set(card_names)) != len(card_names):
+        raise TableBaseError('the five cards must be different')
+    card_data = [ai.create_card(name) for name in card_names]
+    indexer = Indexer(max_pieces)
+    size = len(indexer)
+    values = array('H', bytes(2 * size))
+    # Moves not yet known to lead to a won position for the opponent,
+    # at most 40 (two cards, five pieces, four moves each)
+    remaining = array('B', bytes(size))
+    frontier = array('I')
+    for index in range(size):
+        moves = successors(indexer, card_data, index)
+        if moves is None:
+            values[index] = 2 # win in 1 ply
+            frontier.append(index)
+        elif not moves:
+            values[index] = 1 # lost, no moves
+            frontier.append(index)
+        else:
+            remaining[index] = len(moves)
+    # Positions resolved at one distance, in turn, as a breadth-first search
+    # would take them from a queue
+    while frontier:
+        resolved = array('I')
+        for index in frontier:
+            value = values[index]
+            won = value % 2 == 0
+            for predecessor in predecessors(indexer, card_data, index):
+                if values[predecessor]:
+                    continue
+                if not won:
+                    # Moving into a lost position wins
+                    values[predecessor] = value + 1
+                    resolved.append(predecessor)
+                else:
+                    remaining[predecessor] -= 1
+                    if remaining[predecessor] == 0:
+                        # Every move leads to a won position for the opponent
+                        values[predecessor] = value + 1
+                        resolved.append(predecessor)
+        frontier = resolved
+    return values
+
+def write(path, card_names, max_pieces, values):
+    header = json.dumps({'cards': list(card_names), 'max_pieces': max_pieces}).encode()
+    offset = len(MAGIC) + 4 + len(header)
+    padding = b'\x00' * (offset % 2)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(padding)
+        data = array('H', values)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        f.write(data.tobytes())
+
+
+class TableBase:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise TableBaseError('not a tablebase file: {}'.format(path))
+        length, = struct.unpack_from('<I', self.map, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self.map[start:start+length].decode())
+        self.card_names = header['cards']
+        # Cards are numbered by their place in the header
+        self.card_index = {name: i for i, name in enumerate(self.card_names)}
+        if len(self.card_index) != len(self.card_names):
+            self.close()
+            raise TableBaseError('repeated card names in tablebase file: {}'.format(path))
+        self.max_pieces = header['max_pieces']
+        offset = start + length
+        offset += offset % 2
+        if sys.byteorder == 'little':
+            self.values = memoryview(self.map)[offset:].cast('H')
+        else:
+            # The file is little-endian: read a swapped copy instead of mapping it
+            self.values = array('H', self.map[offset:])
+            self.values.byteswap()
+        self.indexer = Indexer(self.max_pieces)
+        if len(self.values) != len(self.indexer):
+            self.close()
+            raise TableBaseError('truncated tablebase file: {}'.format(path))
+
+    def close(self):
+        self.values = None
+        self.map.close()
+        self.file.close()
+
+    def covers(self, card_data):
+        return sorted(self.card_names) == sorted(card.name for card in card_data)
+
+    # Score of the AI's current position for the side to move, or None if
+    # it is not in the table. Wins and losses are +-(TB_WIN - distance)
+    def probe(self, searcher):
+        red_king, blue_king = searcher.kings
+        red, blue = searcher.bitboards
+        if (red_king is None or blue_king is None
+                or red.bit_count() > self.max_pieces or blue.bit_count() > self.max_pieces):
+            return None
+        card_index = [self.card_index[card.name] for card in searcher.card_data]
+        cards = [card_index[card] for card in searcher.cards]
+        arrangement = (tuple(sorted(cards[0:2])), tuple(sorted(cards[2:4])), cards[4])
+        layout = (
+            red_king,
+            blue_king,
+            SQUARES[red & ~(1 << red_king)],
+            SQUARES[blue & ~(1 << blue_king)],
+        )
+        if layout not in self.indexer.layout_index:
+            return None
+        value = self.values[self.indexer.index(layout, arrangement, searcher.active_player)]
+        if value == 0:
+            return 0
+        distance = value - 1
+        return TB_WIN - distance if distance % 2 else -(TB_WIN - distance)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate an Onitama endgame tablebase')
+    parser.add_argument('cards', nargs=5, help='the five card names')
+    parser.add_argument('--pieces', type=int, default=1,
+                        help='maximum pieces per side, king included: 2 gives 18 million positions, '
+                             'about 9 minutes and 180 MB; 3 would be over 2 billion, out of reach')
+    parser.add_argument('-o', '--output', required=True, help='output file')
+    args = parser.parse_args(argv)
+    card_names = [name.lower() for name in args.cards]
+    try:
+        values = generate(card_names, args.pieces)
+    except TableBaseError as e:
+        parser.error(str(e))
+    write(args.output, card_names, args.pieces, values)
+    wins = sum(1 for value in values if value and value % 2 == 0)
+    losses = sum(1 for value in values if value % 2 == 1)
+    print('{} positions: {} won, {} lost, {} drawn'.format(
+        len(values), wins, losses, len(values) - wins - losses))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -100,6 +100,47 @@ class TestGame(unittest.TestCase):
         with self.assertRaises(onitama.MoveParseError):
             Move.parse_moves(Player.BLUE, string)
 
+    def test_format_moves(self):
+        string = 'c5-c4 [crane] a1-b2 [monkey] f5-d4 [mantis]'
+        moves = Move.parse_moves(Player.BLUE, string)
+        self.assertEqual(Move.format_moves(moves), string)
+
+    def test_game_records(self):
+        import os, tempfile, records
+        lines = [
+            'dragon rooster goose ox crab c5-c4 [ox] b1-d2 [dragon] a5-c5 [crab] d2-d3 [ox] c4-d3 [goose]',
+            'monkey crab tiger elephant rabbit b5-b3 [tiger] c1-b2 [monkey] c5-b4 [elephant] b2-b4 [tiger]',
+            'tiger monkey crab boar mantis',
+        ]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'games.bin')
+        try:
+            self.assertEqual(records.convert(lines, path), 3)
+            self.assertEqual(os.path.getsize(path), len(records.MAGIC) + 3*7 + 5 + 4)
+            with records.RecordReader(path) as reader:
+                self.assertEqual([records.format_game(*record) for record in reader.records()], lines)
+                games = list(reader)
+            self.assertEqual(games[1].check_victory(), Player.RED)
+            self.assertEqual(Move.format_moves(games[0].moves), lines[0].split(' ', 5)[5])
+            # Arena results convert too
+            arena_line = '{"cards": ["monkey", "crab", "tiger", "elephant", "rabbit"], "moves": "b5-b3 [tiger]"}'
+            start_cards, moves = records.parse_game(arena_line)
+            self.assertEqual(records.decode_moves(start_cards, records.encode_moves(start_cards, moves))[0].end, (1, 2))
+            # Truncated files are reported
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with records.RecordReader(path) as reader:
+                with self.assertRaises(records.RecordError):
+                    list(reader.records())
+            with open(path, 'wb') as f:
+                f.write(records.MAGIC)
+            with records.RecordReader(path) as reader:
+                self.assertEqual(list(reader), [])
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(directory)
+
     def test_legal_moves(self):
         lm = self.game.legal_moves()
         self.assertEqual(lm[onitama.MANTIS][(2, 4)], {(1, 3), (3, 3)})
@@ -110,6 +151,74 @@ class TestGame(unittest.TestCase):
             for coord in {(x, y) for x in range(5) for y in range(5)}.difference((x, 4) for x in range(5)):
                 self.assertEqual(lm[card][coord], set())
 
+    def test_legal_move_cache(self):
+        game = Game([onitama.DRAGON, onitama.ROOSTER, onitama.GOOSE, onitama.OX, onitama.CRAB])
+        moves = 'c5-c4 [ox] b1-d2 [dragon] a5-c5 [crab] d2-d3 [ox] c4-d3 [goose]'
+        coords = [(x, y) for x in range(5) for y in range(5)]
+        for move in Move.parse_moves(Player.BLUE, moves):
+            lm = game.legal_moves()
+            self.assertIs(game.legal_moves(), lm)
+            # Same moves as checking every start, end and card
+            expected = {
+                (start, end, card)
+                for start in coords for end in coords for card in game.cards[game.active_player]
+                if game.validate_move(Move(game.active_player, start, end, card))
+            }
+            found = {
+                (start, end, card)
+                for card, targets in lm.items() for start, ends in targets.items() for end in ends
+            }
+            self.assertEqual(found, expected)
+            self.assertEqual(game.legal_move_sources(), {start for start, _, _ in expected})
+            for start, end, card in expected:
+                self.assertIn(end, game.legal_move_targets(start))
+                self.assertIn(card, game.get_card_choices_for_move(start, end))
+            game.do_move(move)
+            self.assertIsNot(game.legal_moves(), lm)
+        # Positions set up by hand are not served from the cache
+        sources = game.legal_move_sources()
+        start = sources.pop()
+        game.board.set(start, Piece.EMPTY)
+        for pieces in [game.pawns, game.kings]:
+            pieces[game.active_player].discard(start)
+        self.assertNotIn(start, game.legal_move_sources())
+
+    def test_undo_and_snapshot(self):
+        game = Game([onitama.DRAGON, onitama.ROOSTER, onitama.GOOSE, onitama.OX, onitama.CRAB])
+        with self.assertRaises(onitama.IllegalMoveError):
+            game.undo_move()
+        moves = Move.parse_moves(Player.BLUE, 'c5-c4 [ox] b1-d2 [dragon] a5-c5 [crab] d2-d3 [ox] c4-d3 [goose]')
+        states = []
+        for move in moves:
+            states.append(game.snapshot())
+            game.do_move(move)
+        final = game.snapshot()
+        self.assertEqual(final.moves, tuple(moves))
+        copy = game.clone()
+        self.assertEqual(copy.snapshot(), final)
+        for move, state in zip(reversed(moves), reversed(states)):
+            lm = game.legal_moves()
+            self.assertIs(game.undo_move(), move)
+            self.assertEqual(game.snapshot(), state)
+            self.assertIsNot(game.legal_moves(), lm)
+        self.assertEqual(game.pawns, Game(game.start_cards).pawns)
+        self.assertEqual(game.kings, Game(game.start_cards).kings)
+        # The clone is independent, and restore puts back the sets and undo history
+        self.assertEqual(copy.snapshot(), final)
+        game.restore(final)
+        self.assertEqual((game.pawns, game.kings), (copy.pawns, copy.kings))
+        self.assertEqual(game.undo_move(), copy.undo_move())
+        self.assertEqual(game.snapshot(), copy.snapshot())
+        # Winning moves can be taken back too
+        cards = [onitama.NAME_TO_CARD[card] for card in ['monkey', 'crab', 'tiger', 'elephant', 'rabbit']]
+        game = Game(cards)
+        for move in Move.parse_moves(Player.BLUE, 'b5-b3 [tiger] c1-b2 [monkey] c5-b4 [elephant] b2-b4 [tiger]'):
+            game.do_move(move)
+        self.assertEqual(game.check_victory(), Player.RED)
+        game.undo_move()
+        self.assertIsNone(game.check_victory())
+        self.assertEqual(game.board.get((1, 3)), Piece.B_KING)
+
     def test_victory(self):
         cardnames = ['monkey', 'crab', 'tiger', 'elephant', 'rabbit']
         cards = [onitama.NAME_TO_CARD[card] for card in cardnames]
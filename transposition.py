@@ -0,0 +1,175 @@
+'''
+Zobrist hashing and transposition tables for the AI
+
+A position is hashed as the XOR of one random key per (piece, square),
+one per (card, owner) where the owner is RED, BLUE or NEUTRAL, and one more
+if BLUE is to move. The keys come from a fixed seed and cards are keyed by name,
+so equal positions hash the same across AI instances, processes and runs.
+
+The AI keeps the hash up to date in do_move/undo_move by XORing out the old
+and XORing in the new keys for the squares and cards that changed
+'''
+from collections import namedtuple
+from multiprocessing import shared_memory
+import random
+import struct
+from constants import *
+
+NEUTRAL = 2
+
+# Bound types for table entries
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+_rng = random.Random(0x0A17A3A)
+
+PIECE_KEYS = {
+    piece: [_rng.getrandbits(64) for _ in range(25)]
+    for piece in [REDPAWN, REDKING, BLUEPAWN, BLUEKING]
+}
+CARD_KEYS = {
+    name: [_rng.getrandbits(64) for _ in range(3)]
+    for name in ['monkey', 'elephant', 'crane', 'mantis', 'tiger', 'dragon',
+                 'boar', 'crab', 'goose', 'rooster', 'eel', 'cobra', 'horse',
+                 'ox', 'frog', 'rabbit']
+}
+SIDE_KEY = _rng.getrandbits(64)
+
+def zobrist_hash(board, cards, card_data, player):
+    # board, cards and card_data as held by MoveUnmoveAI
+    result = SIDE_KEY if player == BLUE else 0
+    for i, piece in enumerate(board):
+        if piece != EMPTY:
+            result ^= PIECE_KEYS[piece][i]
+    for slot, card in enumerate(cards):
+        result ^= CARD_KEYS[card_data[card].name][min(slot // 2, NEUTRAL)]
+    return result
+
+Entry = namedtuple('Entry', ['key', 'depth', 'flag', 'score', 'move', 'generation'])
+
+'''
+Fixed-size table with 2**bits slots, indexed by the low bits of the hash
+The full key is kept in the entry to detect index collisions
+
+Replacement policy: an entry is overwritten by a search of equal or greater depth,
+or by anything once it is left over from an earlier search (see new_search)
+'''
+class TranspositionTable:
+    def __init__(self, bits=18):
+        self.mask = (1 << bits) - 1
+        self.entries = [None] * (1 << bits)
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def new_search(self):
+        self.generation += 1
+
+    def clear(self):
+        self.entries = [None] * len(self.entries)
+        self.generation = 0
+
+    def probe(self, key):
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry.key == key:
+            return entry
+        return None
+
+    def store(self, key, depth, flag, score, move):
+        index = key & self.mask
+        old = self.entries[index]
+        if (old is None or old.key == key or old.generation != self.generation
+                or depth >= old.depth):
+            self.entries[index] = Entry(key, depth, flag, score, move, self.generation)
+
+
+'''
+The same table in shared memory, so that several processes can search with it
+at once, e.g. the workers of parallel.ParallelAI
+
+Each slot is three 64-bit words: check, info and the score's bits, where info
+packs depth, flag, move and generation (see pack_info), and
+check = key ^ info ^ score bits. Writes take no lock: a slot being written by
+one process while another reads it, or written by two at once, fails the
+check on the next probe and reads as a miss. The generation is kept in the
+header, shared by every process using the table.
+
+The process that creates the table owns it and removes it with close.
+Others attach by name, or by unpickling the table, which is how it
+reaches the workers of a process pool.
+'''
+SLOT = struct.Struct('<3Q')
+HEADER = struct.Struct('<Q')
+_SCORE = struct.Struct('<d')
+_BITS = struct.Struct('<Q')
+
+VALID = 1 << 63
+DEPTH_OFFSET = 128
+
+def pack_info(depth, flag, move, generation):
+    return VALID | generation << 32 | move << 10 | flag << 8 | depth + DEPTH_OFFSET
+
+class SharedTranspositionTable:
+    def __init__(self, bits=18, name=None):
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=HEADER.size + (SLOT.size << bits))
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.owner = name is None
+        self.buffer = self.memory.buf
+
+    def __getstate__(self):
+        return {'bits': self.bits, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['bits'], state['name'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return 1 << self.bits
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def generation(self):
+        return HEADER.unpack_from(self.buffer, 0)[0]
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def new_search(self):
+        HEADER.pack_into(self.buffer, 0, self.generation + 1 & 0xFFFF)
+
+    def clear(self):
+        self.buffer[:] = bytes(len(self.buffer))
+
+    def probe(self, key):
+        check, info, bits = SLOT.unpack_from(self.buffer, HEADER.size + (key & self.mask) * SLOT.size)
+        if info & VALID and check ^ info ^ bits == key:
+            return Entry(key, (info & 0xFF) - DEPTH_OFFSET, info >> 8 & 3,
+                         _SCORE.unpack(_BITS.pack(bits))[0], info >> 10 & 0xFFFF, info >> 32 & 0xFFFF)
+        return None
+
+    def store(self, key, depth, flag, score, move):
+        offset = HEADER.size + (key & self.mask) * SLOT.size
+        generation = self.generation
+        check, info, bits = SLOT.unpack_from(self.buffer, offset)
+        if (not info & VALID or check ^ info ^ bits == key or info >> 32 & 0xFFFF != generation
+                or depth >= (info & 0xFF) - DEPTH_OFFSET):
+            info = pack_info(depth, flag, move, generation)
+            bits = _BITS.unpack(_SCORE.pack(score))[0]
+            SLOT.pack_into(self.buffer, offset, key ^ info ^ bits, info, bits)